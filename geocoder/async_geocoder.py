@@ -3,27 +3,43 @@ import boto3
 import aiohttp
 import asyncio
 import asyncpg
-import json
 import csv
 import sys
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from itertools import zip_longest, takewhile
 import time
+from functools import partial
+from batcher import MicroBatcher
+from geocode_cache import GeocodeCache
+from db_writer import BulkUpdateWriter
+from csv_shards import open_csv_range, read_csv_header
+from checkpoint import CompletedRows, CsvCheckpoint, OffsetLineReader, truncate_file
+from limiter import AIMDLimiter, ChainedLimiter, SemaphoreLimiter, TokenBucket
+from retry import RetryPolicy
+from metrics import Metrics
+from normalize import AddressNormalizer
+from columnar import ColumnarReader, ColumnarWriter, is_columnar
+from compression import compression, open_text, strip_compression
+from s3_stream import S3MultipartWriter
+from locality import external_sort
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logging.basicConfig(stream=sys.stdout, level=os.getenv('LOG_LEVEL', 'INFO'))
 log = logging.getLogger()
 
 
-# Itertools chunking from standard lib examples
-def grouper(iterable, n, fillvalue=None):
-    args = [iter(iterable)] * n
-    return zip_longest(*args, fillvalue=fillvalue)
-
-
-def trim_grouper(iterable, n, fillvalue=None):
-    for group in grouper(iterable, n, fillvalue=fillvalue):
-        yield tuple(takewhile((lambda x: x), group))
+async def run_until_first_error(*coros):
+    """
+    Runs coroutines concurrently until all finish, or until one raises, in
+    which case the others are cancelled and the exception is re-raised
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
 
 
 class AsyncGeocoder(object):
@@ -34,11 +50,77 @@ class AsyncGeocoder(object):
 
     The main item that needs to be changed in subclasses is the conn_limit
     property which controls the max amount of HTTP requests at one time. For any
-    rate-limited APIs, you'll need to lower it significantly.
+    rate-limited APIs, you'll need to lower it significantly, and set rate_limit
+    to the allowed requests per second.
+
+    Setting adaptive_concurrency replaces the fixed sem_count with a limit that
+    grows until request latency or errors degrade and then backs off, between
+    min_concurrency and max_concurrency (defaulting to conn_limit).
 
     Any properties can be overriden with kwargs, and in any subclass you'll have
     to implement the request_geocoder method returning an awaited tuple with
     household_id and a dictionary structured as GeoJSON geometry.
+
+    Setting batch_size above zero collects rows into micro-batches of at most
+    batch_size rows (or whatever arrived within batch_wait seconds) which are
+    passed to request_geocoder_batch. Subclasses can override that method to
+    send each batch in a single request.
+
+    Setting normalize canonicalizes address columns before they're geocoded
+    or looked up in the cache (see AddressNormalizer), leaving the output
+    rows as they were.
+
+    With coalesce set, rows with the same (normalized) address as a row
+    already being geocoded wait for that request and share its result,
+    rather than sending their own.
+
+    Setting cache_file caches results by normalized address in memory and in
+    a SQLite file, so unchanged addresses aren't geocoded again on later runs.
+
+    In database mode results are buffered and written write_batch_size rows at
+    a time (or every write_flush_interval seconds) through a staging table.
+    Setting write_batch_size to zero updates each row as it's geocoded.
+
+    To run several geocoders against the same table, set lease_col to a
+    timestamp column. Each batch of rows is then claimed with FOR UPDATE SKIP
+    LOCKED and marked with leased_status until lease_seconds from now, after
+    which rows a crashed worker never finished are claimable again. Leases
+    are renewed while a batch is being geocoded, however long it takes.
+
+    CSV input is streamed through bounded queues: rows are read into a queue of
+    input_queue_size, geocoded by worker_count coroutines, and passed through a
+    queue of output_queue_size to a single writer. Parquet and Arrow IPC files
+    (by extension) can be used for input or output instead of CSV, reading
+    only the cols columns and writing columnar_batch_size rows at a time.
+    CSVs ending in .gz or .zst are read and written compressed, and with
+    stream_upload the output is sent to s3_bucket in upload_part_size parts
+    while rows are still being geocoded instead of being written locally.
+
+    Setting checkpoint writes CSV output in input order and saves the highest
+    contiguous completed row and its input offset to checkpoint_file (by
+    default the output file name ending in .checkpoint) every
+    checkpoint_interval seconds, once the output is fsynced up to that row.
+    At most reorder_window rows are read ahead of the last row written. With
+    resume set, a run picks up from the checkpoint, truncating the output to
+    its saved size and seeking past the rows already geocoded.
+
+    Setting locality_sort sends rows to the geocoder grouped by their
+    locality_cols (state and ZIP code), so consecutive queries and batches
+    hit the same shards and filters. CSV rows are sorted with an external
+    sort holding sort_buffer_rows in memory, and database rows are selected
+    in that order. Row ids are assigned in input order before sorting.
+
+    Transient errors from the geocoder are retried with jittered exponential
+    backoff, within a retry budget of retry_budget_ratio of all requests. Rows
+    that still fail are written to a dead letter CSV (dead_letter_file, by
+    default the output file name ending in _failed.csv) that can be used as the
+    input for a rerun. In database mode they're set to failed_status instead,
+    and also logged to dead_letter_table if set. Setting pending_status to
+    failed_status reprocesses only those rows.
+
+    Throughput, match rate, in-flight requests, queue depths and latency
+    percentiles for each stage are logged every metrics_interval seconds, and
+    served in the Prometheus format at /metrics if metrics_port is set.
     """
     cols = [
         'ID',
@@ -56,10 +138,30 @@ class AsyncGeocoder(object):
     id_col = 'id'
     geo_col = 'geom'
     geo_status_col = None
+    pending_status = 1
+    failed_status = 5
+    dead_letter_table = None
+    lease_col = None
+    lease_seconds = 600
+    leased_status = 4
 
     csv_file = None
+    # Byte range of csv_file to geocode and the id of its first row, for
+    # splitting a CSV across processes
+    csv_start = None
+    csv_end = None
+    row_offset = 0
     output_file = None
+    checkpoint = False
+    checkpoint_file = None
+    checkpoint_interval = 60
+    reorder_window = 10000
+    resume = False
+    columnar_batch_size = 10000
     s3_bucket = None
+    stream_upload = False
+    upload_part_size = 8 * 1024 * 1024
+    upload_threads = 4
     es_host = None
     state = None
 
@@ -67,16 +169,76 @@ class AsyncGeocoder(object):
     conn_limit = 50
     query_limit = 1000
 
+    locality_sort = False
+    locality_cols = ['STATE_NAME', 'ZIP_CODE']
+    sort_buffer_rows = 100000
+    sort_dir = None
+
+    rate_limit = None
+    rate_burst = None
+    adaptive_concurrency = False
+    min_concurrency = 1
+    max_concurrency = None
+    latency_tolerance = 2.0
+    limiter = None
+
+    retry_budget_ratio = 0.1
+    retry_policy = None
+    dead_letter_file = None
+    dead_letter_f = None
+    dead_letter_writer = None
+
+    metrics_interval = 60
+    metrics_port = None
+    # Asyncio debug mode adds a lot of overhead, so it's off unless needed
+    debug = False
+
+    worker_count = 1000
+    input_queue_size = 1000
+    output_queue_size = 1000
+
+    batch_size = 0
+    batch_wait = 0.01
+    batcher = None
+
+    normalize = False
+    normalizer = None
+    coalesce = True
+
+    cache_file = None
+    cache_size = 100000
+    cache_negative_ttl = 30 * 24 * 3600
+    cache = None
+
+    write_batch_size = 1000
+    write_flush_interval = 1.0
+    db_writer = None
+
     def __init__(self, *args, **kwargs):
         for k, v in kwargs.items():
             setattr(self, k, v)
+        self.in_flight = 0
+        # Requests in progress by address key, for coalescing
+        self.pending_requests = {}
+        if self.normalize and self.normalizer is None:
+            self.normalizer = AddressNormalizer()
+        self.metrics = Metrics()
+        self.metrics.gauge('in_flight_requests', lambda: self.in_flight)
 
     def run(self):
         sem = asyncio.Semaphore(self.sem_count)
         loop = asyncio.get_event_loop()
-        loop.set_debug(enabled=True)
+        loop.set_debug(enabled=self.debug)
         conn = aiohttp.TCPConnector(limit=self.conn_limit, verify_ssl=False)
         client = aiohttp.ClientSession(connector=conn, loop=loop)
+        self.limiter = self.make_limiter(sem)
+        self.retry_policy = RetryPolicy(budget_ratio=self.retry_budget_ratio)
+        if self.cache_file:
+            self.cache = GeocodeCache(
+                self.cache_file,
+                max_size=self.cache_size,
+                negative_ttl=self.cache_negative_ttl
+            )
         self.time1 = time.time()
         loop.run_until_complete(self.geocoder_loop(sem, client))
 
@@ -85,51 +247,280 @@ class AsyncGeocoder(object):
         Indefinitely loops through the geocoder coroutine, continuing to query
         the database, geocode rows, and update the database with returned values.
         """
+        metrics_tasks = [
+            asyncio.ensure_future(self.metrics.log_periodically(self.metrics_interval))
+        ]
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = await self.metrics.serve(self.metrics_port)
+        if self.batch_size:
+            self.batcher = MicroBatcher(
+                partial(self.flush_batch, sem, client),
+                max_size=self.batch_size,
+                max_wait=self.batch_wait
+            )
         if self.csv_file:
             await self.csv_loop(sem, client)
         else:
             self.query_limit *= 10
             await self.db_loop(sem, client)
+        if self.batcher:
+            await self.batcher.close()
         client.close()
+        for task in metrics_tasks:
+            task.cancel()
+        if metrics_server:
+            metrics_server.close()
         time2 = time.time()
         print('Geocoding took {:2.4f} seconds'.format(time2-self.time1))
-        if self.s3_bucket:
-            s3 = boto3.resource('s3')
-            s3.Object(self.s3_bucket, self.output_file).upload_file(self.output_file)
+        print(self.metrics.report(since_start=True))
+        print(self.retry_policy.stats())
+        if self.cache:
+            print(self.cache.stats())
+            self.cache.close()
+        if self.s3_bucket and not self.stream_upload:
+            self.upload_output()
+
+    def upload_output(self):
+        s3 = boto3.resource('s3')
+        s3.Object(self.s3_bucket, self.output_file).upload_file(self.local_output_file())
 
     async def csv_loop(self, sem, client):
-        # Cleaning up CSV output (so that full S3 paths can be used even if local dirs don't exist
-        csv_output_file = os.path.join('data', self.output_file.split('/')[-1])
-        output_f = open(csv_output_file, 'w')
         fieldnames = [c.lower() for c in self.cols] + ['lat', 'lon']
+        columnar = is_columnar(self.csv_file) or is_columnar(self.local_output_file())
+        if self.checkpoint or self.resume or self.csv_start is not None:
+            if columnar or compression(self.csv_file):
+                raise ValueError(
+                    'Checkpointing and sharding are only supported for uncompressed CSV input'
+                )
+        if (self.checkpoint or self.resume) and (compression(self.output_file) or self.stream_upload):
+            raise ValueError('Checkpointing is only supported for uncompressed local CSV output')
+        if (self.checkpoint or self.resume) and self.locality_sort:
+            # Checkpoints need rows to finish in input order
+            raise ValueError('Checkpointing is not supported with locality_sort')
+        checkpoint = None
+        if self.checkpoint or self.resume:
+            checkpoint = self.make_checkpoint()
+
+        input_f = None
+        if is_columnar(self.csv_file):
+            input_f = ColumnarReader(self.csv_file, self.cols, batch_size=self.columnar_batch_size)
 
-        writer = csv.DictWriter(output_f, delimiter=',', fieldnames=fieldnames)
-        writer.writeheader()
-        output_executor = ThreadPoolExecutor(max_workers=8)
+        sink = None
+        if self.stream_upload and self.s3_bucket:
+            sink = S3MultipartWriter(
+                self.s3_bucket,
+                self.output_file,
+                part_size=self.upload_part_size,
+                threads=self.upload_threads
+            )
 
-        input_f = open(self.csv_file, 'r')
-        reader = enumerate(csv.DictReader(input_f, delimiter=','))
-        input_executor = ThreadPoolExecutor(max_workers=8)
+        if is_columnar(self.local_output_file()):
+            types = {}
+            if input_f:
+                types = {name.lower(): t for name, t in input_f.types.items()}
+            writer = output_f = ColumnarWriter(
+                self.local_output_file(),
+                fieldnames,
+                types=types,
+                batch_size=self.columnar_batch_size,
+                sink=sink
+            )
+        elif checkpoint and checkpoint.resumed:
+            # Resuming, so the output already has a header
+            output_f = open(self.local_output_file(), 'a')
+            writer = csv.DictWriter(output_f, delimiter=',', fieldnames=fieldnames)
+        else:
+            output_f = open_text(self.local_output_file(), 'w', fileobj=sink)
+            writer = csv.DictWriter(output_f, delimiter=',', fieldnames=fieldnames)
+            writer.writeheader()
 
-        csv_slice_gen = trim_grouper(
-            (input_executor.submit(self.yield_csv_rows, (i, r)) for i, r in reader),
-            self.query_limit
+        if input_f:
+            rows = input_f
+        elif checkpoint:
+            input_f = OffsetLineReader(
+                self.csv_file, checkpoint.input_offset, checkpoint.input_end
+            )
+            rows = csv.DictReader(input_f, fieldnames=read_csv_header(self.csv_file)[0])
+        elif self.csv_start is not None:
+            input_f = open_csv_range(self.csv_file, self.csv_start, self.csv_end)
+            rows = csv.DictReader(input_f, fieldnames=read_csv_header(self.csv_file)[0])
+        else:
+            input_f = open_text(self.csv_file, 'r')
+            rows = csv.DictReader(input_f, delimiter=',')
+        input_queue = asyncio.Queue(maxsize=self.input_queue_size)
+        output_queue = asyncio.Queue(maxsize=self.output_queue_size)
+        self.metrics.gauge('input_queue_depth', input_queue.qsize)
+        self.metrics.gauge('output_queue_depth', output_queue.qsize)
+
+        try:
+            await run_until_first_error(
+                self.read_csv_rows(rows, input_queue, checkpoint, input_f),
+                self.write_csv_rows(writer, output_f, output_queue, checkpoint, sink),
+                *[self.csv_worker(sem, client, input_queue, output_queue, checkpoint)
+                  for _ in range(self.worker_count)]
+            )
+            output_f.close()
+            if sink:
+                # Only publish the object once everything was written
+                await sink.complete()
+        except Exception:
+            # Don't leave a partial upload behind (S3 keeps its parts until aborted)
+            if sink:
+                sink.abort()
+            raise
+        finally:
+            input_f.close()
+
+    def local_output_file(self):
+        # Cleaning up CSV output (so that full S3 paths can be used even if local dirs don't exist
+        return os.path.join('data', self.output_file.split('/')[-1])
+
+    def local_dead_letter_file(self):
+        if self.dead_letter_file:
+            return os.path.join('data', self.dead_letter_file.split('/')[-1])
+        return '{}_failed.csv'.format(
+            os.path.splitext(strip_compression(self.local_output_file()))[0]
         )
 
-        async with sem:
-            for row_slice in csv_slice_gen:
-                await asyncio.gather(*(
-                    self.handle_update(
-                        sem, client, row.result(),
-                        executor=output_executor, writer=writer
-                    )
-                    for row in as_completed(row_slice)
+    def local_checkpoint_file(self):
+        if self.checkpoint_file:
+            return os.path.join('data', self.checkpoint_file.split('/')[-1])
+        return '{}.checkpoint'.format(self.local_output_file())
+
+    def make_checkpoint(self):
+        """
+        Creates the checkpoint for a CSV run, starting from the saved one when
+        resuming and truncating the output files back to where it was saved
+        """
+        _, data_start = read_csv_header(self.csv_file)
+        input_start = self.csv_start if self.csv_start is not None else data_start
+        input_end = self.csv_end if self.csv_end is not None else os.path.getsize(self.csv_file)
+        checkpoint = CsvCheckpoint(
+            self.local_checkpoint_file(),
+            self.csv_file,
+            input_start,
+            input_end,
+            self.row_offset,
+            window_size=self.reorder_window,
+            interval=self.checkpoint_interval
+        )
+
+        state = CsvCheckpoint.load(checkpoint.path) if self.resume else None
+        if state is None:
+            if self.resume:
+                log.warning('No checkpoint at {}, starting from the first row'.format(
+                    checkpoint.path
                 ))
+            return checkpoint
+        if state['csv_file'] != self.csv_file or state['input_end'] != input_end:
+            raise ValueError('Checkpoint {} is for a different input than {}'.format(
+                checkpoint.path, self.csv_file
+            ))
+        if not os.path.exists(self.local_output_file()):
+            log.warning('Output for checkpoint {} is missing, starting from the first row'.format(
+                checkpoint.path
+            ))
+            return checkpoint
 
-        input_executor.shutdown()
-        input_f.close()
-        output_executor.shutdown()
-        output_f.close()
+        truncate_file(self.local_output_file(), state['output_offset'])
+        if os.path.exists(self.local_dead_letter_file()):
+            # Rows written after the checkpoint are dropped even when it had
+            # none, in which case the first failed row rewrites the header
+            truncate_file(self.local_dead_letter_file(), state['dead_letter_offset'])
+            if state['dead_letter_offset']:
+                self.dead_letter_f = open(self.local_dead_letter_file(), 'a')
+                self.dead_letter_writer = self.make_dead_letter_writer(self.dead_letter_f)
+        checkpoint.input_offset = state['input_offset']
+        checkpoint.next_row = state['row']
+        checkpoint.resumed = True
+        log.info('Resuming {} from row {}'.format(self.csv_file, checkpoint.next_row))
+        return checkpoint
+
+    async def read_csv_rows(self, rows, input_queue, checkpoint=None, input_f=None):
+        """
+        Producer for csv_loop, blocking whenever the input queue is full, or
+        when checkpointing, whenever the reorder window is full. Puts one None
+        on the queue per worker once the input is exhausted.
+        """
+        first_row = checkpoint.next_row if checkpoint else self.row_offset
+        reader = enumerate(rows, first_row)
+        if self.locality_sort:
+            reader = external_sort(
+                reader,
+                lambda indexed_row: self.locality_key(indexed_row[1]),
+                buffer_size=self.sort_buffer_rows,
+                tmp_dir=self.sort_dir
+            )
+        for i, r in reader:
+            row = self.yield_csv_rows((i, r))
+            if checkpoint:
+                await checkpoint.window.acquire()
+                await input_queue.put((i, input_f.offset, row))
+            else:
+                await input_queue.put(row)
+        for _ in range(self.worker_count):
+            await input_queue.put(None)
+
+    async def csv_worker(self, sem, client, input_queue, output_queue, checkpoint=None):
+        while True:
+            row = await input_queue.get()
+            if row is None:
+                # Passing on the sentinel so the writer knows this worker is done
+                await output_queue.put(None)
+                return
+            if checkpoint:
+                # The writer needs to know when a row is done even if it has no output
+                row_idx, offset, row = row
+                completed = CompletedRows()
+                await self.handle_update(sem, client, row, output_queue=completed)
+                await output_queue.put((row_idx, offset, completed.rows))
+            else:
+                await self.handle_update(sem, client, row, output_queue=output_queue)
+
+    async def write_csv_rows(self, writer, output_f, output_queue, checkpoint=None, sink=None):
+        """
+        Consumer for csv_loop, writing rows as they finish (or in input order
+        when checkpointing), and waiting for a streamed upload to catch up
+        before taking more rows
+        """
+        finished_workers = 0
+        while finished_workers < self.worker_count:
+            row = await output_queue.get()
+            if sink and sink.needs_drain:
+                await sink.drain()
+            if row is None:
+                finished_workers += 1
+            elif checkpoint:
+                checkpoint.complete(*row)
+                for ready_row in checkpoint.ready_rows():
+                    self.write_output_row(writer, ready_row)
+                if checkpoint.due():
+                    checkpoint.save(output_f, self.dead_letter_f)
+            else:
+                self.write_output_row(writer, row)
+        if checkpoint:
+            checkpoint.save(output_f, self.dead_letter_f)
+        if self.dead_letter_f:
+            self.dead_letter_f.close()
+
+    def write_output_row(self, writer, row):
+        """Writes a geocoded row, or a failed one to the dead letter file"""
+        if 'error' in row:
+            if self.dead_letter_writer is None:
+                self.dead_letter_f = open(self.local_dead_letter_file(), 'w')
+                self.dead_letter_writer = self.make_dead_letter_writer(self.dead_letter_f)
+                self.dead_letter_writer.writeheader()
+            self.write_csv_row(self.dead_letter_writer, row)
+        else:
+            self.write_csv_row(writer, row)
+
+    def make_dead_letter_writer(self, dead_letter_f):
+        return csv.DictWriter(
+            dead_letter_f,
+            delimiter=',',
+            fieldnames=[c.lower() for c in self.cols] + ['error']
+        )
 
     def yield_csv_rows(self, row):
         i, row = row
@@ -141,34 +532,159 @@ class AsyncGeocoder(object):
         return row_dict
 
     def write_csv_row(self, writer, row):
-        writer.writerow(row)
+        with self.metrics.timer('csv_write'):
+            writer.writerow(row)
 
     async def db_loop(self, sem, client):
         pool = await asyncpg.create_pool(**self.db_config)
+        if self.dead_letter_table:
+            async with pool.acquire() as conn:
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS {} (
+                        id text,
+                        error text,
+                        failed_at timestamp with time zone DEFAULT now()
+                    )'''.format(self.dead_letter_table)
+                )
+        if self.write_batch_size:
+            self.db_writer = BulkUpdateWriter(
+                pool,
+                self.db_table,
+                self.id_col,
+                self.geo_col,
+                self.geo_status_col,
+                batch_size=self.write_batch_size,
+                flush_interval=self.write_flush_interval,
+                metrics=self.metrics
+            )
+            self.metrics.gauge('write_buffer_depth', lambda: len(self.db_writer.buffer))
+            self.db_writer.start()
         async with sem:
             while True:
                 addrs_to_geocode = await self.get_unmatched_addresses(pool)
                 if not len(addrs_to_geocode):
                     break
-                await asyncio.gather(
-                    *[self.handle_update(sem, client, row, pool=pool)
-                    for row in addrs_to_geocode]
-                )
+                renewal = None
+                if self.lease_col:
+                    renewal = asyncio.ensure_future(self.renew_leases(
+                        pool, [self.row_id(row) for row in addrs_to_geocode]
+                    ))
+                try:
+                    await asyncio.gather(
+                        *[self.handle_update(sem, client, row, pool=pool)
+                        for row in addrs_to_geocode]
+                    )
+                    # Write everything back before querying for unmatched rows again
+                    if self.db_writer:
+                        await self.db_writer.flush()
+                finally:
+                    if renewal:
+                        renewal.cancel()
+        if self.db_writer:
+            await self.db_writer.close()
 
     async def get_unmatched_addresses(self, pool):
+        if self.lease_col:
+            return await self.claim_unmatched_addresses(pool)
         async with pool.acquire() as conn:
             async with conn.transaction():
                 # Run the query passing the request argument.
-                query_address = 'SELECT {} FROM {} WHERE {} = 1'.format(
-                    ', '.join(self.cols), self.db_table, self.geo_status_col
+                query_address = 'SELECT {} FROM {} WHERE {} = {}'.format(
+                    ', '.join(self.cols), self.db_table, self.geo_status_col, self.pending_status
                 )
+                query_args = []
                 if self.state:
-                    query_address += '\nAND state_name = {}'.format(self.state)
+                    query_address += '\nAND state_name = $1'
+                    query_args.append(self.state)
+                if self.locality_sort:
+                    query_address += '\nORDER BY {}'.format(', '.join(self.locality_cols))
                 query_address += '\nLIMIT {}'.format(self.query_limit)
 
-                return await conn.fetch(query_address)
+                return await conn.fetch(query_address, *query_args)
+
+    async def claim_unmatched_addresses(self, pool):
+        """
+        Atomically claims a batch of unmatched rows (or rows whose lease has
+        expired) for this worker, skipping any rows locked by other workers.
+        """
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                state_filter = ''
+                order_by = ''
+                if self.locality_sort:
+                    order_by = 'ORDER BY {}'.format(', '.join(self.locality_cols))
+                query_args = [self.lease_seconds]
+                if self.state:
+                    state_filter = 'AND state_name = $2'
+                    query_args.append(self.state)
+
+                claim_statement = '''
+                    UPDATE {table}
+                    SET
+                        {status_col} = {leased},
+                        {lease_col} = now() + $1::integer * interval '1 second'
+                    WHERE {id_col} IN (
+                        SELECT {id_col} FROM {table}
+                        WHERE (
+                            {status_col} = {pending} OR
+                            ({status_col} = {leased} AND {lease_col} < now())
+                        )
+                        {state_filter}
+                        {order_by}
+                        LIMIT {limit}
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING {cols}
+                    '''.format(
+                        table=self.db_table,
+                        status_col=self.geo_status_col,
+                        pending=self.pending_status,
+                        leased=self.leased_status,
+                        lease_col=self.lease_col,
+                        id_col=self.id_col,
+                        state_filter=state_filter,
+                        order_by=order_by,
+                        limit=self.query_limit,
+                        cols=', '.join(self.cols)
+                    )
+
+                rows = await conn.fetch(claim_statement, *query_args)
+                if self.locality_sort:
+                    # RETURNING doesn't keep the order rows were selected in
+                    rows.sort(key=self.locality_key)
+                return rows
+
+    async def renew_leases(self, pool, row_ids):
+        """
+        Extends the lease on the claimed rows that haven't been written yet
+        every third of lease_seconds until cancelled, so a batch that takes
+        longer than one lease isn't claimed by another worker midway
+        """
+        renew_statement = '''
+            UPDATE {table}
+            SET {lease_col} = now() + $1::integer * interval '1 second'
+            WHERE {id_col} = ANY($2) AND {status_col} = {leased}
+            '''.format(
+                table=self.db_table,
+                lease_col=self.lease_col,
+                id_col=self.id_col,
+                status_col=self.geo_status_col,
+                leased=self.leased_status
+            )
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                async with pool.acquire() as conn:
+                    await conn.execute(renew_statement, self.lease_seconds, row_ids)
+            except Exception as e:
+                # The next renewal may still succeed before the lease expires
+                log.warning('Renewing leases failed: {!r}'.format(e))
 
     async def update_address(self, pool, household_id, addr_dict):
+        with self.metrics.timer('db_write'):
+            await self.execute_update(pool, household_id, addr_dict)
+
+    async def execute_update(self, pool, household_id, addr_dict):
         async with pool.acquire() as conn:
             async with conn.transaction():
                 if addr_dict:
@@ -196,20 +712,62 @@ class AsyncGeocoder(object):
                     )
                 await conn.execute(update_statement)
 
+    async def mark_failed(self, pool, household_id):
+        async with pool.acquire() as conn:
+            await conn.execute(
+                'UPDATE {} SET {} = {} WHERE {} = $1'.format(
+                    self.db_table, self.geo_status_col, self.failed_status, self.id_col
+                ),
+                household_id
+            )
+
+    async def log_dead_letter(self, pool, household_id, error):
+        async with pool.acquire() as conn:
+            await conn.execute(
+                'INSERT INTO {} (id, error) VALUES ($1, $2)'.format(self.dead_letter_table),
+                str(household_id), repr(error)
+            )
+
     async def handle_update(self, sem, client, row, **kwargs):
-        async with sem:
-            u_id, geom = await self.request_geocoder(client, row)
-        if u_id:
+        try:
+            with self.metrics.timer('row'):
+                u_id, geom = await self.geocode_row(sem, client, row)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning('Geocoding row {} failed: {!r}'.format(self.row_id(row), e))
+            self.metrics.incr('failed')
+            await self.handle_failure(sem, row, e, **kwargs)
+            return
+
+        if u_id is not None:
+            self.metrics.incr('matched' if geom else 'unmatched')
             if self.csv_file:
                 if geom:
                     row.update(geom)
-                kwargs['executor'].submit(
-                    lambda x: self.write_csv_row(kwargs['writer'], x), row
-                )
+                await kwargs['output_queue'].put(row)
+            elif self.db_writer:
+                await self.db_writer.add(u_id, geom)
             else:
                 async with sem:
                     await self.update_address(kwargs['pool'], u_id, geom)
 
+    async def handle_failure(self, sem, row, error, **kwargs):
+        """
+        Sends a row that couldn't be geocoded to the dead letter output
+        """
+        if self.csv_file:
+            row['error'] = repr(error)
+            await kwargs['output_queue'].put(row)
+        elif self.db_writer:
+            await self.db_writer.add(self.row_id(row), None, status=self.failed_status)
+        else:
+            async with sem:
+                await self.mark_failed(kwargs['pool'], self.row_id(row))
+        if not self.csv_file and self.dead_letter_table:
+            async with sem:
+                await self.log_dead_letter(kwargs['pool'], self.row_id(row), error)
+
     async def request_geocoder(self, client, row):
         """
         Main method that needs to be implemented in subclasses, asynchronously
@@ -220,3 +778,168 @@ class AsyncGeocoder(object):
             - row: Dictionary-like object with the input address data
         """
         raise NotImplementedError('Must implement request_geocoder method')
+
+    async def geocode_row(self, sem, client, row):
+        """
+        Returns the id and geometry for a row, checking the cache if enabled
+        before sending the row to the geocoder.
+        """
+        row = self.prepare_row(row)
+        key = self.address_key(row)
+        if self.cache:
+            found, geom = self.cache_get(key)
+            if found:
+                return self.row_id(row), geom
+
+        while self.coalesce and key in self.pending_requests:
+            pending = self.pending_requests[key]
+            self.metrics.incr('coalesced_requests')
+            try:
+                # Shielded so that one waiting row being cancelled doesn't cancel the others
+                u_id, geom = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The row sending the request was cancelled rather than this
+                # one, so wait for another row's request or send it instead
+                continue
+            return (self.row_id(row) if u_id is not None else None), geom
+
+        u_id, geom = await self.shared_request(key, sem, client, row)
+
+        if self.cache and u_id is not None:
+            self.cache_set(key, geom)
+        return u_id, geom
+
+    def cache_get(self, key):
+        """Cache lookup that treats errors (like a locked file) as misses"""
+        try:
+            return self.cache.get(key)
+        except Exception as e:
+            self.metrics.incr('cache_errors')
+            log.warning('Reading {!r} from the cache failed: {!r}'.format(key, e))
+            return False, None
+
+    def cache_set(self, key, geom):
+        """Caches a result, logging rather than raising errors so the row isn't failed"""
+        try:
+            self.cache.set(key, geom)
+        except Exception as e:
+            self.metrics.incr('cache_errors')
+            log.warning('Writing {!r} to the cache failed: {!r}'.format(key, e))
+
+    async def shared_request(self, key, sem, client, row):
+        """
+        Geocodes a row with retries, sharing the result (or exception) with
+        any rows that have the same address key while it's in progress
+        """
+        if not self.coalesce:
+            return await self.retry_policy.call(self.request_row, sem, client, row)
+        pending = asyncio.Future()
+        self.pending_requests[key] = pending
+        try:
+            result = await self.retry_policy.call(self.request_row, sem, client, row)
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            # Retrieving the exception stops it being logged when nothing was waiting
+            pending.exception()
+            raise
+        else:
+            pending.set_result(result)
+            return result
+        finally:
+            del self.pending_requests[key]
+
+    async def request_row(self, sem, client, row):
+        if self.batcher:
+            return await self.batcher.submit(row)
+        async with self.request_slot(sem):
+            return await self.timed_request(self.request_geocoder(client, row))
+
+    async def timed_request(self, request):
+        self.in_flight += 1
+        try:
+            with self.metrics.timer('request'):
+                return await request
+        finally:
+            self.in_flight -= 1
+
+    def prepare_row(self, row):
+        """Row as it's sent to the geocoder, normalized if normalize is set"""
+        if self.normalizer:
+            return self.normalizer.normalize_row(row)
+        return row
+
+    def row_id(self, row):
+        row = dict(row)
+        return row.get('id', row.get(self.id_col))
+
+    def address_key(self, row):
+        """
+        Normalized string of the address columns in a row, ignoring case,
+        extra whitespace and the id column
+        """
+        row = dict(row)
+        key_vals = []
+        for c in self.cols:
+            if c.lower() in ('id', self.id_col.lower()):
+                continue
+            val = row.get(c, row.get(c.lower()))
+            key_vals.append(' '.join(str(val or '').lower().split()))
+        return '|'.join(key_vals)
+
+    def locality_key(self, row):
+        """Sort key of a row's locality_cols, ignoring case and extra whitespace"""
+        row = dict(row)
+        return tuple(
+            ' '.join(str(row.get(c, row.get(c.lower())) or '').lower().split())
+            for c in self.locality_cols
+        )
+
+    def make_limiter(self, sem):
+        """
+        Builds the limiter held around each geocoder request, or None if the
+        semaphore alone should limit concurrency
+        """
+        if self.adaptive_concurrency:
+            concurrency = AIMDLimiter(
+                initial=self.sem_count,
+                min_limit=self.min_concurrency,
+                max_limit=self.max_concurrency or self.conn_limit,
+                latency_tolerance=self.latency_tolerance
+            )
+        else:
+            concurrency = SemaphoreLimiter(sem)
+
+        if self.rate_limit:
+            return ChainedLimiter([
+                concurrency, TokenBucket(self.rate_limit, capacity=self.rate_burst)
+            ])
+        elif self.adaptive_concurrency:
+            return concurrency
+        return None
+
+    def request_slot(self, sem):
+        """Context manager to hold around each request to the geocoder"""
+        if self.limiter:
+            return self.limiter.request()
+        return sem
+
+    async def flush_batch(self, sem, client, rows):
+        async with self.request_slot(sem):
+            return await self.timed_request(self.request_geocoder_batch(client, rows))
+
+    async def request_geocoder_batch(self, client, rows):
+        """
+        Geocodes a list of rows, returning a list of (id, geometry) tuples in
+        the same order, or exceptions for rows that failed. Defaults to calling
+        request_geocoder for each row, so subclasses only need to override this
+        if the service has a bulk API.
+        """
+        return await asyncio.gather(
+            *[self.request_geocoder(client, row) for row in rows],
+            return_exceptions=True
+        )
@@ -0,0 +1,65 @@
+import asyncio
+
+
+class MicroBatcher(object):
+    """
+    Collects individual items submitted from many coroutines into micro-batches,
+    handing each batch to flush_fn once it reaches max_size items or once the
+    oldest pending item has waited max_wait seconds, whichever comes first.
+
+    flush_fn must be a coroutine function taking a list of items and returning
+    a list of results in the same order. Each result is fanned back out to the
+    coroutine that submitted the matching item, and any result that's an
+    exception is raised there instead.
+    """
+
+    def __init__(self, flush_fn, max_size=100, max_wait=0.01):
+        self.flush_fn = flush_fn
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.loop = asyncio.get_event_loop()
+        self.pending = []
+        self.timer = None
+        self.in_flight = set()
+
+    async def submit(self, item):
+        fut = self.loop.create_future()
+        self.pending.append((item, fut))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.max_wait, self.flush)
+        return await fut
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.ensure_future(self.run_batch(batch))
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+
+    async def run_batch(self, batch):
+        try:
+            results = await self.flush_fn([item for item, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut), res in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(res, Exception):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+    async def close(self):
+        """Flushes anything still pending and waits for in-flight batches"""
+        self.flush()
+        if self.in_flight:
+            await asyncio.wait(list(self.in_flight))
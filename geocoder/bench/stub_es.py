@@ -0,0 +1,147 @@
+import json
+import math
+import random
+import asyncio
+from collections import defaultdict
+from aiohttp import web
+
+
+def collect_terms(query, terms=None):
+    """Gathers every term clause in a query into a dict of field to values"""
+    if terms is None:
+        terms = defaultdict(list)
+    if isinstance(query, dict):
+        for k, v in query.items():
+            if k == 'term':
+                for field, value in v.items():
+                    if isinstance(value, dict):
+                        value = value.get('value')
+                    terms[field].append(value)
+            else:
+                collect_terms(v, terms)
+    elif isinstance(query, list):
+        for q in query:
+            collect_terms(q, terms)
+    return terms
+
+
+def filter_source(source, includes):
+    """Copy of a document with only the dotted paths in includes"""
+    filtered = {}
+    for path in includes:
+        keys = path.split('.')
+        value = source
+        for k in keys:
+            if not isinstance(value, dict) or k not in value:
+                break
+            value = value[k]
+        else:
+            target = filtered
+            for k in keys[:-1]:
+                target = target.setdefault(k, {})
+            target[keys[-1]] = value
+    return filtered
+
+
+def apply_filter_path(obj, paths):
+    """
+    Applies ES filter_path paths (as lists of keys, without wildcards) to a
+    response, dropping objects left empty like ES does
+    """
+    if isinstance(obj, list):
+        items = [apply_filter_path(v, paths) for v in obj]
+        return [v for v in items if v != {}]
+    elif not isinstance(obj, dict):
+        return obj
+    filtered = {}
+    for key, value in obj.items():
+        if [key] in paths:
+            filtered[key] = value
+            continue
+        sub_paths = [p[1:] for p in paths if len(p) > 1 and p[0] == key]
+        if sub_paths:
+            value = apply_filter_path(value, sub_paths)
+            if value not in ({}, []):
+                filtered[key] = value
+    return filtered
+
+
+class StubElasticsearch(object):
+    """
+    Answers the census queries ElasticGeocoder sends to _search and _msearch
+    from features held in memory, after a log-normally distributed delay with
+    a median of latency_ms plus per_query_ms for each search in an _msearch.
+    Only ZIP code, house number range and street name terms are matched, so
+    results are close enough to ES for benchmarking but not for accuracy.
+    _source includes and filter_path are applied to responses.
+    """
+
+    def __init__(self, features, latency_ms=5.0, latency_sigma=0.5, per_query_ms=0.2, seed=0):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.per_query_ms = per_query_ms
+        self.rng = random.Random(seed)
+        self.by_zip = defaultdict(list)
+        for feat in features:
+            props = feat['properties']
+            for zip_code in {props['ZIPL'], props['ZIPR']}:
+                self.by_zip[zip_code].append(
+                    (set(props['FULLNAME'].lower().split()), feat)
+                )
+
+    def delay(self, query_count=1):
+        latency = self.rng.lognormvariate(math.log(self.latency_ms), self.latency_sigma)
+        return (latency + self.per_query_ms * (query_count - 1)) / 1000.0
+
+    def search(self, query):
+        terms = collect_terms(query)
+        numbers = terms.get('properties.LRANGE', []) + terms.get('properties.RRANGE', [])
+        streets = set(str(s).lower() for s in terms.get('properties.FULLNAME', []))
+        hits = []
+        for zip_code in set(terms.get('properties.ZIPL', [])):
+            for street_tokens, feat in self.by_zip.get(zip_code, []):
+                if streets and not streets & street_tokens:
+                    continue
+                props = feat['properties']
+                if any(props[side]['gte'] <= int(n) <= props[side]['lte']
+                       for n in numbers for side in ['LRANGE', 'RRANGE']):
+                    source = feat
+                    if isinstance(query.get('_source'), dict):
+                        source = filter_source(feat, query['_source'].get('includes', []))
+                    hits.append({'_source': source})
+                    break
+        return {
+            'took': 1,
+            'timed_out': False,
+            'hits': {'total': len(hits), 'hits': hits[:query.get('size', 10)]}
+        }
+
+    def respond(self, request, response_json):
+        filter_path = request.rel_url.query.get('filter_path')
+        if filter_path:
+            paths = [p.split('.') for p in filter_path.split(',')]
+            response_json = apply_filter_path(response_json, paths)
+        return web.json_response(response_json)
+
+    async def handle_search(self, request):
+        query = json.loads(await request.text())
+        await asyncio.sleep(self.delay())
+        return self.respond(request, self.search(query))
+
+    async def handle_msearch(self, request):
+        lines = [l for l in (await request.text()).split('\n') if l.strip()]
+        queries = [json.loads(l) for l in lines[1::2]]
+        await asyncio.sleep(self.delay(len(queries)))
+        return self.respond(request, {'responses': [self.search(q) for q in queries]})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/{index}/_search', self.handle_search)
+        app.router.add_post('/{index}/_msearch', self.handle_msearch)
+        return app
+
+
+def run_stub(port, features, **kwargs):
+    """Runs the stub server until the process is stopped"""
+    stub = StubElasticsearch(features, **kwargs)
+    web.run_app(stub.make_app(), port=port)
@@ -0,0 +1,110 @@
+import csv
+import random
+
+STREET_NAMES = [
+    'Main', 'Oak', 'Pine', 'Maple', 'Cedar', 'Elm', 'Washington', 'Lake', 'Hill',
+    'Park', 'Jefferson', 'Lincoln', 'Madison', 'Ridge', 'River', 'Sunset',
+    'Highland', 'Forest', 'Spring', 'Church', 'Mill', 'Walnut', 'Chestnut',
+    'Franklin', 'Jackson', 'Adams', 'Union', 'Market', 'Broad', 'Center'
+]
+STREET_SUFFIXES = ['St', 'Ave', 'Rd', 'Dr', 'Ln', 'Way', 'Blvd', 'Ct', 'Pl', 'Ter']
+PLACES = [
+    ('Seattle', ['98101', '98102', '98103', '98104', '98105']),
+    ('Spokane', ['99201', '99202', '99203']),
+    ('Tacoma', ['98402', '98403', '98404']),
+    ('Olympia', ['98501', '98502']),
+    ('Yakima', ['98901', '98902'])
+]
+
+VOTER_COLS = [
+    'ID',
+    'ADDRESS_NUMBER',
+    'STREET_NAME',
+    'STREET_NAME_POST_TYPE',
+    'PLACE_NAME',
+    'STATE_NAME',
+    'ZIP_CODE'
+]
+
+
+def make_range_props(side, range_from, range_to):
+    return {
+        '{}FROMHN'.format(side): str(range_from),
+        '{}TOHN'.format(side): str(range_to),
+        '{}FROMINT'.format(side): range_from,
+        '{}TOINT'.format(side): range_to,
+        '{}RANGE'.format(side): {'gte': min(range_from, range_to), 'lte': max(range_from, range_to)},
+        '{}EVEN'.format(side): range_from % 2 == 0 and range_to % 2 == 0
+    }
+
+
+def generate_addrfeat(count, state='WA', seed=0):
+    """
+    Yields synthetic TIGER ADDRFEAT edges shaped like the documents created by
+    es_tiger_loader, each one block of a street with even numbers on the left
+    and odd on the right
+    """
+    rng = random.Random(seed)
+    for tlid in range(count):
+        place, zips = rng.choice(PLACES)
+        zip_code = rng.choice(zips)
+        street = '{} {}'.format(rng.choice(STREET_NAMES), rng.choice(STREET_SUFFIXES))
+        block = rng.randint(1, 99) * 100
+
+        lon, lat = rng.uniform(-124.5, -117.0), rng.uniform(45.6, 49.0)
+        coords = [[lon, lat]]
+        for _ in range(rng.randint(1, 5)):
+            lon += rng.uniform(-0.001, 0.001)
+            lat += rng.uniform(-0.001, 0.001)
+            coords.append([lon, lat])
+
+        props = {
+            'TLID': tlid,
+            'FULLNAME': street,
+            'PLACE': place,
+            'STATE': state,
+            'ZIPL': zip_code,
+            'ZIPR': zip_code
+        }
+        left, right = (block, block + 98), (block + 1, block + 99)
+        if rng.random() < 0.5:
+            left, right = left[::-1], right[::-1]
+        props.update(make_range_props('L', *left))
+        props.update(make_range_props('R', *right))
+
+        yield {
+            'type': 'Feature',
+            'geometry': {'type': 'LineString', 'coordinates': coords},
+            'properties': props
+        }
+
+
+def generate_voters(path, features, row_count, match_rate=0.9, seed=0):
+    """
+    Writes a voter CSV with row_count addresses, match_rate of which fall
+    within one of the features' address ranges. Addresses repeat the way
+    households with several registrants do.
+    """
+    rng = random.Random(seed)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(VOTER_COLS)
+        for i in range(row_count):
+            feat = rng.choice(features)
+            props = feat['properties']
+            street_name, suffix = props['FULLNAME'].rsplit(' ', 1)
+            if rng.random() < match_rate:
+                side = rng.choice(['L', 'R'])
+                low = props['{}RANGE'.format(side)]['gte']
+                address_number = low + 2 * rng.randint(0, 49)
+            else:
+                address_number = rng.randint(10000, 99999)
+            writer.writerow([
+                i,
+                address_number,
+                street_name,
+                suffix,
+                props['PLACE'],
+                props['STATE'],
+                props['ZIPL']
+            ])
@@ -0,0 +1,162 @@
+import os
+import csv
+import json
+import time
+import socket
+import asyncio
+import asyncpg
+import argparse
+import resource
+import multiprocessing
+from es_geocoder import ElasticGeocoder
+from bench.synthetic import generate_addrfeat, generate_voters
+from bench.stub_es import run_stub
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark ElasticGeocoder against a stub Elasticsearch with synthetic data'
+)
+
+parser.add_argument('--rows', dest='rows', type=int, default=100000,
+                    help='Number of synthetic voter rows to geocode')
+parser.add_argument('--streets', dest='streets', type=int, default=5000,
+                    help='Number of synthetic ADDRFEAT edges in the stub index')
+parser.add_argument('--match_rate', dest='match_rate', type=float, default=0.9,
+                    help='Fraction of voter addresses that fall in an edge range')
+parser.add_argument('--latency_ms', dest='latency_ms', type=float, default=5.0,
+                    help='Median stub Elasticsearch response time in milliseconds')
+parser.add_argument('--latency_sigma', dest='latency_sigma', type=float, default=0.5,
+                    help='Spread of the log-normal stub response time')
+parser.add_argument('--port', dest='port', type=int, default=9250,
+                    help='Port for the stub Elasticsearch server')
+parser.add_argument('-m', '--mode', dest='mode', choices=['csv', 'db'], default='csv',
+                    help='Run through csv_loop, or db_loop against a local Postgres')
+parser.add_argument('--db_config', dest='db_config', required=False,
+                    help='JSON file with asyncpg connection settings for db mode')
+parser.add_argument('-c', '--config', dest='config', default='{}',
+                    help='JSON object of ElasticGeocoder settings, like {"batch_size": 100}')
+parser.add_argument('--seed', dest='seed', type=int, default=0,
+                    help='Random seed for the synthetic data')
+
+BENCH_TABLE = 'bench_household_dim'
+BENCH_VOTERS = os.path.join('data', 'bench_voters.csv')
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Stub Elasticsearch did not start on port {}'.format(port))
+
+
+async def load_bench_table(db_config, voters_file):
+    """
+    Loads the synthetic voters into a fresh table shaped like household_dim,
+    which needs PostGIS (the mdillon/postgis Docker image works)
+    """
+    conn = await asyncpg.connect(**db_config)
+    await conn.execute('DROP TABLE IF EXISTS {}'.format(BENCH_TABLE))
+    await conn.execute('''
+        CREATE TABLE {} (
+            household_id integer PRIMARY KEY,
+            address_number text,
+            street_name text,
+            street_name_post_type text,
+            place_name text,
+            state_name text,
+            zip_code text,
+            geom geometry(Point, 4326),
+            geocode_status integer DEFAULT 1,
+            lease_expires timestamp with time zone
+        )'''.format(BENCH_TABLE)
+    )
+    with open(voters_file, 'r') as f:
+        reader = csv.reader(f)
+        next(reader)
+        records = [[int(r[0])] + r[1:] for r in reader]
+    await conn.copy_records_to_table(
+        BENCH_TABLE,
+        records=records,
+        columns=[
+            'household_id', 'address_number', 'street_name', 'street_name_post_type',
+            'place_name', 'state_name', 'zip_code'
+        ]
+    )
+    await conn.close()
+
+
+def bench_kwargs(args):
+    geo_kwargs = dict(es_host='localhost', es_port=args.port)
+    if args.mode == 'csv':
+        geo_kwargs.update(
+            csv_file=BENCH_VOTERS,
+            output_file=os.path.join('data', 'bench_output.csv')
+        )
+    else:
+        with open(args.db_config, 'r') as f:
+            db_config = json.load(f)
+        asyncio.get_event_loop().run_until_complete(
+            load_bench_table(db_config, BENCH_VOTERS)
+        )
+        geo_kwargs.update(
+            db_config=db_config,
+            db_table=BENCH_TABLE,
+            id_col='household_id',
+            geo_status_col='geocode_status',
+            cols=[
+                'household_id',
+                'address_number',
+                'street_name',
+                'street_name_post_type',
+                'place_name',
+                'state_name',
+                'zip_code'
+            ]
+        )
+    geo_kwargs.update(json.loads(args.config))
+    return geo_kwargs
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.mode == 'db' and not args.db_config:
+        parser.error('--db_config is required in db mode')
+
+    features = list(generate_addrfeat(args.streets, seed=args.seed))
+    generate_voters(BENCH_VOTERS, features, args.rows, match_rate=args.match_rate, seed=args.seed)
+
+    stub = multiprocessing.Process(
+        target=run_stub,
+        args=(args.port, features),
+        kwargs=dict(latency_ms=args.latency_ms, latency_sigma=args.latency_sigma, seed=args.seed)
+    )
+    stub.daemon = True
+    stub.start()
+    try:
+        wait_for_port(args.port)
+        elastic_geo = ElasticGeocoder(**bench_kwargs(args))
+        start = time.time()
+        elastic_geo.run()
+        elapsed = time.time() - start
+    finally:
+        stub.terminate()
+
+    metrics = elastic_geo.metrics
+    row_hist = metrics.histogram('row')
+    rows = metrics.rows()
+    print('\nBenchmark ({} mode, {} rows, config {})'.format(args.mode, rows, args.config))
+    print('  rows/s: {:.1f}'.format(rows / elapsed if elapsed else 0.0))
+    print('  row latency p50/p99: {:.1f}/{:.1f}ms'.format(
+        row_hist.quantile(0.5) * 1000, row_hist.quantile(0.99) * 1000
+    ))
+    print('  match rate: {:.1f}%'.format(
+        100.0 * metrics.counters.get('matched', 0) / rows if rows else 0.0
+    ))
+    # ru_maxrss is in kilobytes on Linux
+    print('  peak RSS: {:.1f}MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    ))
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import asyncio
+
+
+class OffsetLineReader(object):
+    """
+    Iterates over the decoded lines of a file between byte offsets start and
+    end, tracking the offset just past the last line read. Since csv.reader
+    only pulls the lines it needs for each record, offset is always where the
+    next CSV row starts.
+    """
+
+    def __init__(self, path, start, end=None):
+        self.f = open(path, 'rb')
+        self.f.seek(start)
+        self.offset = start
+        self.end = end
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.end is not None and self.offset >= self.end:
+            raise StopIteration
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8')
+
+    def close(self):
+        self.f.close()
+
+
+class CompletedRows(object):
+    """
+    Stands in for the output queue while a single row is geocoded, collecting
+    whatever rows it produces so they can be written back in input order
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    async def put(self, row):
+        self.rows.append(row)
+
+
+def truncate_file(path, size):
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+
+
+def sync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class CsvCheckpoint(object):
+    """
+    Tracks the highest contiguous completed row of a CSV run and periodically
+    saves it to path, along with the input offset where the next row starts
+    and the sizes of the output files once they're fsynced up to that row.
+
+    Rows complete out of order, so their output is held until every earlier
+    row has completed. At most window_size rows can be read ahead of the
+    last row written, which bounds how much output is held.
+    """
+
+    def __init__(self, path, csv_file, input_offset, input_end, next_row,
+                 window_size=10000, interval=60):
+        self.path = path
+        self.csv_file = csv_file
+        self.input_offset = input_offset
+        self.input_end = input_end
+        self.next_row = next_row
+        self.interval = interval
+        self.window = asyncio.Semaphore(window_size)
+        self.pending = {}
+        self.resumed = False
+        self.last_saved = time.time()
+
+    @staticmethod
+    def load(path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def complete(self, row_idx, offset, rows):
+        """Records a finished row, its end offset in the input and its output rows"""
+        self.pending[row_idx] = (offset, rows)
+
+    def ready_rows(self):
+        """Yields output rows in input order, up to the first row still in progress"""
+        while self.next_row in self.pending:
+            offset, rows = self.pending.pop(self.next_row)
+            for row in rows:
+                yield row
+            self.next_row += 1
+            self.input_offset = offset
+            self.window.release()
+
+    def due(self):
+        return time.time() - self.last_saved >= self.interval
+
+    def save(self, output_f, dead_letter_f=None):
+        """
+        Flushes and fsyncs the output files before atomically replacing the
+        checkpoint, so the checkpoint never points past what's on disk
+        """
+        sync_file(output_f)
+        if dead_letter_f:
+            sync_file(dead_letter_f)
+        state = {
+            'csv_file': self.csv_file,
+            'input_offset': self.input_offset,
+            'input_end': self.input_end,
+            'row': self.next_row,
+            'output_offset': output_f.tell(),
+            'dead_letter_offset': dead_letter_f.tell() if dead_letter_f else 0
+        }
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            sync_file(f)
+        os.replace(tmp_path, self.path)
+        self.last_saved = time.time()
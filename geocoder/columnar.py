@@ -0,0 +1,143 @@
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+PARQUET_EXTS = ['.parquet', '.pq']
+ARROW_EXTS = ['.arrow', '.feather', '.ipc']
+
+
+def file_format(path):
+    """Returns 'parquet', 'arrow' or 'csv' from a file's extension"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in PARQUET_EXTS:
+        return 'parquet'
+    elif ext in ARROW_EXTS:
+        return 'arrow'
+    return 'csv'
+
+
+def is_columnar(path):
+    return file_format(path) != 'csv'
+
+
+def require_pyarrow(path):
+    if pa is None:
+        raise ImportError('pyarrow is required to read and write {}'.format(path))
+
+
+class ColumnarReader(object):
+    """
+    Iterates over the rows of a Parquet or Arrow IPC file as dicts, like
+    csv.DictReader. Only columns named in cols (in any case) are read, one
+    record batch of at most batch_size rows at a time.
+    """
+
+    def __init__(self, path, cols, batch_size=10000):
+        require_pyarrow(path)
+        self.path = path
+        self.batch_size = batch_size
+        col_names = set(c.lower() for c in cols)
+        if file_format(path) == 'parquet':
+            self.parquet_file = pq.ParquetFile(path)
+            schema = self.parquet_file.schema.to_arrow_schema()
+        else:
+            self.source = pa.memory_map(path, 'r')
+            try:
+                self.ipc_reader = pa.ipc.open_file(self.source)
+            except pa.ArrowInvalid:
+                # Not the random access format, so read it as a stream
+                self.source.seek(0)
+                self.ipc_reader = pa.ipc.open_stream(self.source)
+            schema = self.ipc_reader.schema
+        self.columns = [name for name in schema.names if name.lower() in col_names]
+        self.types = {name: schema.field(name).type for name in self.columns}
+
+    def iter_batches(self):
+        if file_format(self.path) == 'parquet':
+            # Reading by row group keeps only one in memory
+            for idx in range(self.parquet_file.num_row_groups):
+                table = self.parquet_file.read_row_group(idx, columns=self.columns)
+                for batch in table.to_batches(self.batch_size):
+                    yield batch
+        elif isinstance(self.ipc_reader, pa.ipc.RecordBatchFileReader):
+            for idx in range(self.ipc_reader.num_record_batches):
+                yield self.ipc_reader.get_batch(idx)
+        else:
+            for batch in self.ipc_reader:
+                yield batch
+
+    def __iter__(self):
+        for batch in self.iter_batches():
+            batch_cols = [batch.column(batch.schema.get_field_index(c)).to_pylist()
+                          for c in self.columns]
+            for values in zip(*batch_cols):
+                yield dict(zip(self.columns, values))
+
+    def close(self):
+        if file_format(self.path) != 'parquet':
+            self.source.close()
+
+
+class ColumnarWriter(object):
+    """
+    Writes rows to a Parquet or Arrow IPC file with the same writerow
+    interface as csv.DictWriter, buffering them into record batches of
+    batch_size rows with lat and lon as float columns. Columns take their
+    types from types, or are written as strings. If sink is set, it's
+    written to instead of path, whose extension still picks the format.
+    """
+
+    def __init__(self, path, fieldnames, types=None, batch_size=10000, sink=None):
+        require_pyarrow(path)
+        self.path = path
+        self.fieldnames = fieldnames
+        self.batch_size = batch_size
+        types = types or {}
+        self.schema = pa.schema([
+            pa.field(name, pa.float64() if name in ('lat', 'lon') else types.get(name, pa.string()))
+            for name in fieldnames
+        ])
+        if file_format(path) == 'parquet':
+            self.writer = pq.ParquetWriter(sink if sink is not None else path, self.schema)
+        else:
+            self.sink = sink if sink is not None else pa.OSFile(path, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, self.schema)
+        self.rows = []
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def column_values(self, field):
+        values = [row.get(field.name) for row in self.rows]
+        if field.type == pa.string():
+            return [None if v is None else str(v) for v in values]
+        return values
+
+    def flush(self):
+        if not self.rows:
+            return
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(self.column_values(f), type=f.type) for f in self.schema],
+            self.fieldnames
+        )
+        if file_format(self.path) == 'parquet':
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if file_format(self.path) != 'parquet':
+            self.sink.close()
@@ -0,0 +1,66 @@
+import io
+import os
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_EXTS = {
+    '.gz': 'gzip',
+    '.gzip': 'gzip',
+    '.zst': 'zstd',
+    '.zstd': 'zstd'
+}
+# Lower than gzip's default of 9, which is much slower for little gain
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def compression(path):
+    """Returns 'gzip', 'zstd' or None from a file's extension"""
+    return COMPRESSION_EXTS.get(os.path.splitext(path)[1].lower())
+
+
+def strip_compression(path):
+    """Path without its compression extension, like data.csv for data.csv.gz"""
+    if compression(path):
+        return os.path.splitext(path)[0]
+    return path
+
+
+def open_binary(path, mode='rb', fileobj=None):
+    """
+    Opens path for reading or writing bytes, compressed according to its
+    extension. If fileobj is set it's used instead of opening path, and
+    left open when the returned file is closed.
+    """
+    kind = compression(path)
+    if kind == 'gzip':
+        if fileobj is not None:
+            return gzip.GzipFile(fileobj=fileobj, mode=mode, compresslevel=GZIP_LEVEL)
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL)
+    elif kind == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is required to read and write {}'.format(path))
+        if 'r' in mode:
+            return zstandard.open(
+                fileobj if fileobj is not None else path, mode, closefd=False
+            )
+        return zstandard.open(
+            fileobj if fileobj is not None else path,
+            mode,
+            cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL),
+            closefd=False
+        )
+    elif fileobj is not None:
+        return fileobj
+    return open(path, mode)
+
+
+def open_text(path, mode='r', fileobj=None):
+    """Text mode version of open_binary, for reading and writing CSVs"""
+    if compression(path) is None and fileobj is None:
+        return open(path, mode)
+    return io.TextIOWrapper(open_binary(path, mode + 'b', fileobj=fileobj))
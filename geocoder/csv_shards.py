@@ -0,0 +1,153 @@
+import io
+import os
+import csv
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from compression import open_binary
+
+
+class ByteRangeReader(io.RawIOBase):
+    """
+    Raw binary reader over the bytes of a file between start and end, so
+    that a shard of a CSV can be wrapped in a text reader without copying it
+    """
+
+    def __init__(self, path, start, end):
+        self.f = open(path, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.remaining)
+        if n <= 0:
+            return 0
+        data = self.f.read(n)
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        super(ByteRangeReader, self).close()
+
+
+def open_csv_range(path, start, end):
+    return io.TextIOWrapper(
+        io.BufferedReader(ByteRangeReader(path, start, end)),
+        encoding='utf-8',
+        newline=''
+    )
+
+
+def read_csv_header(path):
+    """Returns the CSV header fields and the byte offset where the data starts"""
+    with open(path, 'rb') as f:
+        header_line = f.readline()
+        data_start = f.tell()
+    fieldnames = next(csv.reader([header_line.decode('utf-8')]))
+    return fieldnames, data_start
+
+
+def split_csv(path, shard_count):
+    """
+    Splits the data portion of a CSV into roughly equal byte ranges, moving
+    each boundary forward to the start of the next line. Assumes fields don't
+    contain quoted line breaks.
+    """
+    _, data_start = read_csv_header(path)
+    file_size = os.path.getsize(path)
+    boundaries = [data_start]
+    with open(path, 'rb') as f:
+        for k in range(1, shard_count):
+            f.seek(data_start + (k * (file_size - data_start)) // shard_count)
+            f.readline()
+            boundaries.append(max(f.tell(), boundaries[-1]))
+    boundaries.append(file_size)
+    return [(s, e) for s, e in zip(boundaries, boundaries[1:]) if e > s]
+
+
+def count_csv_rows(shard):
+    """Counts rows in a byte range the same way csv.DictReader does, skipping blanks"""
+    path, start, end = shard
+    with open_csv_range(path, start, end) as f:
+        return sum(1 for row in csv.reader(f) if row)
+
+
+def run_shard(geocoder_cls, geo_kwargs):
+    geocoder = geocoder_cls(**geo_kwargs)
+    geocoder.run()
+    return geocoder.local_output_file()
+
+
+def merge_csv_parts(part_files, output_file):
+    """
+    Concatenates CSV parts in order, keeping only the first part's header,
+    and compressing them if output_file ends in .gz or .zst
+    """
+    with open_binary(output_file, 'wb') as out_f:
+        for idx, part_file in enumerate(part_files):
+            with open(part_file, 'rb') as part_f:
+                header = part_f.readline()
+                if idx == 0:
+                    out_f.write(header)
+                shutil.copyfileobj(part_f, out_f)
+            os.remove(part_file)
+
+
+def run_sharded(geocoder_cls, geo_kwargs, shard_count):
+    """
+    Geocodes a CSV across shard_count processes, each running its own
+    geocoder over a byte range of the input and writing its own part file.
+    Row ids are offset by the rows in earlier shards so they match a
+    single-process run, and the parts are merged in order into output_file.
+    """
+    csv_file = geo_kwargs['csv_file']
+    shards = split_csv(csv_file, shard_count)
+    geocoder = geocoder_cls(**geo_kwargs)
+    dead_letter_file = geocoder.local_dead_letter_file()
+
+    with ProcessPoolExecutor(max_workers=shard_count) as executor:
+        row_counts = list(executor.map(
+            count_csv_rows, [(csv_file, s, e) for s, e in shards]
+        ))
+
+        shard_futures = []
+        row_offset = 0
+        for idx, ((start, end), row_count) in enumerate(zip(shards, row_counts)):
+            shard_kwargs = dict(geo_kwargs)
+            shard_kwargs.update(
+                csv_start=start,
+                csv_end=end,
+                row_offset=row_offset,
+                output_file='{}.part{}'.format(geo_kwargs['output_file'], idx),
+                dead_letter_file='{}.part{}'.format(dead_letter_file, idx)
+            )
+            if geo_kwargs.get('metrics_port'):
+                # Each shard serves its own metrics on the next port up
+                shard_kwargs['metrics_port'] = geo_kwargs['metrics_port'] + idx
+            if geo_kwargs.get('checkpoint_file'):
+                shard_kwargs['checkpoint_file'] = '{}.part{}'.format(
+                    geo_kwargs['checkpoint_file'], idx
+                )
+            # Only the merged output is uploaded
+            shard_kwargs.pop('s3_bucket', None)
+            shard_kwargs.pop('stream_upload', None)
+            shard_futures.append(executor.submit(run_shard, geocoder_cls, shard_kwargs))
+            row_offset += row_count
+
+        part_files = [f.result() for f in shard_futures]
+
+    merge_csv_parts(part_files, geocoder.local_output_file())
+    # Shards only write dead letter files if some of their rows failed
+    dead_letter_parts = [
+        os.path.join('data', '{}.part{}'.format(dead_letter_file.split('/')[-1], idx))
+        for idx in range(len(shards))
+    ]
+    dead_letter_parts = [f for f in dead_letter_parts if os.path.exists(f)]
+    if dead_letter_parts:
+        merge_csv_parts(dead_letter_parts, dead_letter_file)
+    if geocoder.s3_bucket:
+        geocoder.upload_output()
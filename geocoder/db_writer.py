@@ -0,0 +1,115 @@
+import asyncio
+import logging
+
+log = logging.getLogger()
+
+
+class BulkUpdateWriter(object):
+    """
+    Buffers geocoding results for the database and writes them in batches,
+    copying each batch into a temporary staging table and then updating the
+    target table from it in a single statement. Flushes whenever batch_size
+    results are buffered, and at least every flush_interval seconds while
+    running. Flushes run one at a time, so awaiting flush also waits for a
+    write already in progress, and a batch that fails to write goes back
+    into the buffer to be retried.
+    """
+    staging_table = 'geocode_staging'
+
+    def __init__(self, pool, db_table, id_col, geo_col, geo_status_col,
+                 batch_size=1000, flush_interval=1.0, metrics=None):
+        self.pool = pool
+        self.db_table = db_table
+        self.id_col = id_col
+        self.geo_col = geo_col
+        self.geo_status_col = geo_status_col
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self.buffer = []
+        self.flush_task = None
+        self.lock = asyncio.Lock()
+
+    def start(self):
+        self.flush_task = asyncio.ensure_future(self.flush_periodically())
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+    async def add(self, household_id, addr_dict, status=None):
+        if addr_dict:
+            self.buffer.append((household_id, addr_dict['lon'], addr_dict['lat'], status or 3))
+        else:
+            self.buffer.append((household_id, None, None, status or 2))
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Periodic flush of geocoding results failed')
+
+    async def flush(self):
+        async with self.lock:
+            if not self.buffer:
+                return
+            records, self.buffer = self.buffer, []
+            try:
+                if self.metrics:
+                    with self.metrics.timer('db_write'):
+                        await self.write_records(records)
+                else:
+                    await self.write_records(records)
+            except BaseException:
+                # The transaction was rolled back, so keep the records (ahead
+                # of any added since) for the next flush
+                self.buffer[:0] = records
+                raise
+
+    async def write_records(self, records):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    CREATE TEMP TABLE {staging} ON COMMIT DROP AS
+                    SELECT
+                        {id_col} AS id,
+                        NULL::double precision AS lon,
+                        NULL::double precision AS lat,
+                        NULL::integer AS status
+                    FROM {table}
+                    WITH NO DATA
+                    '''.format(
+                        staging=self.staging_table,
+                        id_col=self.id_col,
+                        table=self.db_table
+                    )
+                )
+                await conn.copy_records_to_table(
+                    self.staging_table,
+                    records=records,
+                    columns=['id', 'lon', 'lat', 'status']
+                )
+                await conn.execute('''
+                    UPDATE {table} AS t
+                    SET
+                        {geo_col} = CASE
+                            WHEN s.lon IS NULL THEN t.{geo_col}
+                            ELSE ST_SetSRID(ST_MakePoint(s.lon, s.lat), 4326)
+                        END,
+                        {status_col} = s.status
+                    FROM {staging} AS s
+                    WHERE t.{id_col} = s.id
+                    '''.format(
+                        table=self.db_table,
+                        geo_col=self.geo_col,
+                        status_col=self.geo_status_col,
+                        staging=self.staging_table,
+                        id_col=self.id_col
+                    )
+                )
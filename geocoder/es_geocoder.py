@@ -1,14 +1,88 @@
 from async_geocoder import AsyncGeocoder
 import asyncio
-from shapely.geometry import Point, LineString
-import json
+from interpolation import interpolate_lines
+from retry import GeocoderError, ServiceUnavailable
+from normalize import DIRECTIONAL_FORMS
+from json_codec import Placeholder, QueryTemplate, make_json_codec
+import os
 import sys
 import logging
 import re
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logging.basicConfig(stream=sys.stdout, level=os.getenv('LOG_LEVEL', 'INFO'))
 log = logging.getLogger()
 
+# Only the fields used to interpolate hits, so ES skips loading and sending
+# the rest of each TIGER feature
+LEAN_SOURCE = {
+    'census': [
+        'geometry',
+        'properties.LFROMINT',
+        'properties.LTOINT',
+        'properties.RFROMINT',
+        'properties.RTOINT'
+    ],
+    'address': ['geometry']
+}
+# Response paths kept in lean mode. timed_out is in every successful response,
+# so searches without hits aren't dropped from _msearch responses.
+SEARCH_FILTER_PATH = 'hits.hits._source,timed_out,error,status'
+MSEARCH_FILTER_PATH = ','.join('responses.' + p for p in SEARCH_FILTER_PATH.split(','))
+
+
+def parse_house_number(address_number):
+    """Integer portion of an address number, or 0 if it has no digits"""
+    digits = re.sub('[^0-9]', '', str(address_number or ''))
+    return int(digits) if digits else 0
+
+
+def census_query(addr_int, is_even, state, zip_code, street_terms, should_terms):
+    """
+    Census query body for a house number in a state and ZIP code, requiring
+    each term in street_terms and preferring matches of should_terms
+    """
+    # Either side's numeric range can contain the address, preferring the
+    # side with matching parity
+    side_queries = [
+        {
+            'bool': {
+                'filter': [{'term': {'properties.{}RANGE'.format(side): addr_int}}],
+                'should': [{'term': {'properties.{}EVEN'.format(side): is_even}}]
+            }
+        }
+        for side in ['L', 'R']
+    ]
+    return {
+        'query': {
+            'bool': {
+                'must': [
+                    {
+                        'bool': {
+                            'should': side_queries,
+                            'minimum_should_match': 1
+                        }
+                    }
+                ] + street_terms,
+                'should': should_terms,
+                'filter': {
+                    'bool': {
+                        'must': [
+                            {'term': {'properties.STATE': state}},
+                            {
+                                'bool': {
+                                    'should': [
+                                        {'term': {'properties.ZIPL': zip_code}},
+                                        {'term': {'properties.ZIPR': zip_code}}
+                                    ]
+                                }
+                            }
+                        ]
+                    }
+                }
+            }
+        }
+    }
+
 
 class ElasticGeocoder(AsyncGeocoder):
     """
@@ -20,7 +94,21 @@ class ElasticGeocoder(AsyncGeocoder):
     conn_limit = 100
 
     q_type = 'census'
+    # Interpolate along great circle distance rather than planar degrees
+    geodesic_interpolation = False
+    # Search only the per-state alias (like census-wa) for each row's state,
+    # rather than every state's shards, falling back to the q_type alias for
+    # rows without a two letter state
+    state_routing = False
+    # Normalize addresses before querying, see AddressNormalizer
+    normalize = True
+    # Ask for one hit with only the fields needed to interpolate it, and
+    # render census queries from a pre-serialized template
+    lean_requests = True
+    # 'orjson', 'ujson' or 'json', defaulting to the fastest installed
+    json_backend = None
     es_host = None
+    es_port = 9200
     # Mapping of columns to desired ones here, substitute other columns names
     # as the new keys, while the values should remain the same
     col_map = {
@@ -37,37 +125,163 @@ class ElasticGeocoder(AsyncGeocoder):
 
     def __init__(self, *args, **kwargs):
         super(ElasticGeocoder, self).__init__(self, *args, **kwargs)
-        self.es_url = 'http://{}:9200/{}/_search'.format(self.es_host, self.q_type)
+        self.es_base_url = 'http://{}:{}'.format(self.es_host, self.es_port)
+        self.es_url = '{}/{}/_search'.format(self.es_base_url, self.q_type)
+        self.es_msearch_url = '{}/{}/_msearch'.format(self.es_base_url, self.q_type)
+        self.json = make_json_codec(self.json_backend)
+        self.census_template = None
+        if self.lean_requests:
+            self.es_url += '?filter_path={}'.format(SEARCH_FILTER_PATH)
+            self.es_msearch_url += '?filter_path={}'.format(MSEARCH_FILTER_PATH)
+            self.census_template = QueryTemplate(
+                self.lean_query(census_query(
+                    Placeholder('addr_int'),
+                    Placeholder('is_even'),
+                    Placeholder('state'),
+                    Placeholder('zip_code'),
+                    [Placeholder('street_terms')],
+                    [Placeholder('should_terms')]
+                )),
+                codec=self.json
+            )
 
     async def request_geocoder(self, client, row):
+        row, query_body = await self.build_query(row)
+        es_url = self.es_url
+        index = self.row_index(row)
+        if index != self.q_type:
+            # States that haven't been loaded have no alias, and no matches
+            es_url = '{}/{}/_search?ignore_unavailable=true'.format(self.es_base_url, index)
+            if self.lean_requests:
+                es_url += '&filter_path={}'.format(SEARCH_FILTER_PATH)
+
+        async with client.post(es_url, data=query_body) as response:
+            if response.status >= 400:
+                raise self.status_error(response.status, await response.text())
+            response_json = self.json.loads(await response.read())
+            return await self.parse_response(row, response_json)
+
+    async def request_geocoder_batch(self, client, rows):
+        """
+        Sends a batch of rows as a single _msearch request, returning the
+        (id, geometry) tuples in the same order as the input rows.
+        """
+        queries = []
+        for row in rows:
+            queries.append(await self.build_query(row))
+        body = ''.join(
+            '{}\n{}\n'.format(self.json.dumps(self.msearch_header(row)), query_body)
+            for row, query_body in queries
+        )
+
+        async with client.post(
+            self.es_msearch_url,
+            data=body,
+            headers={'Content-Type': 'application/x-ndjson'}
+        ) as response:
+            if response.status >= 400:
+                raise self.status_error(response.status, await response.text())
+            response_json = self.json.loads(await response.read())
+
+        responses = response_json.get('responses', [])
+        if len(responses) != len(queries):
+            log.error('_msearch returned {} responses for {} queries'.format(
+                len(responses), len(queries)
+            ))
+
+        responses = responses[:len(queries)]
+        responses += [{'error': 'Missing from _msearch response', 'status': 500}] * (
+            len(queries) - len(responses)
+        )
+        return await self.parse_responses([row for row, _ in queries], responses)
+
+    async def build_query(self, row):
+        """Returns the row with its columns renamed, and its serialized query"""
         # Replace col names
         row = dict(row)
         for k, v in self.col_map.items():
             if k in row:
                 row[v] = row.pop(k, None)
 
-        if self.q_type == 'census':
+        if self.q_type == 'census' and self.census_template:
+            return row, self.census_template.render(**self.census_query_values(row))
+        elif self.q_type == 'census':
             query_data = await self.create_census_query(row)
         elif self.q_type == 'address':
             query_data = await self.create_point_query(row)
+            if self.lean_requests:
+                query_data = self.lean_query(query_data)
 
-        async with client.post(self.es_url, data=json.dumps(query_data)) as response:
-            response_json = await response.json()
-            if not 'hits' in response_json:
-                return row['id'], None
-            elif response_json['hits'].get('hits', 0) == 0:
-                return row['id'], None
-            elif len(response_json['hits']['hits']) == 0:
-                return row['id'], None
-
-            addr_hit = response_json['hits']['hits'][0]
-            if self.q_type == 'address':
+        return row, self.json.dumps(query_data)
+
+    def lean_query(self, query_data):
+        return dict(query_data, size=1, _source={'includes': LEAN_SOURCE[self.q_type]})
+
+    def row_index(self, row):
+        """Index or alias to search for a row, after its columns are renamed"""
+        state = str(row.get('state_name') or '').strip().lower()
+        if self.state_routing and len(state) == 2 and state.isalpha():
+            return '{}-{}'.format(self.q_type, state)
+        return self.q_type
+
+    def msearch_header(self, row):
+        index = self.row_index(row)
+        if index == self.q_type:
+            return {}
+        return {'index': index, 'ignore_unavailable': True}
+
+    def status_error(self, status, error):
+        """
+        Exception for an error status, treating rejections when ES search
+        queues are full (429) and server errors as transient
+        """
+        if status == 429 or status >= 500:
+            return ServiceUnavailable('Elasticsearch returned {}: {}'.format(status, error))
+        return GeocoderError('Elasticsearch returned {}: {}'.format(status, error))
+
+    async def parse_response(self, row, response_json):
+        results = await self.parse_responses([row], [response_json])
+        if isinstance(results[0], Exception):
+            raise results[0]
+        return results[0]
+
+    async def parse_responses(self, rows, responses):
+        """
+        Returns (id, geometry) tuples for rows and their matching ES responses,
+        interpolating all census hits together in one batch. Responses with
+        errors, as _msearch returns for individual searches, are returned as
+        exceptions.
+        """
+        hits = [self.first_hit(r) for r in responses]
+        results = [(row['id'], None) for row in rows]
+        for idx, res in enumerate(responses):
+            if 'error' in res:
+                results[idx] = self.status_error(res.get('status', 500), res['error'])
+        matched = [idx for idx, hit in enumerate(hits) if hit is not None]
+
+        if self.q_type == 'address':
+            for idx in matched:
+                addr_hit = hits[idx]
                 geom_dict = dict(lon=addr_hit['geometry']['coordinates'][0],
                                  lat=addr_hit['geometry']['coordinates'][1])
-            elif self.q_type == 'census':
-                geom_dict = await self.interpolate_census(row, addr_hit)
+                results[idx] = (rows[idx]['id'], geom_dict)
+        elif self.q_type == 'census':
+            geoms = await self.interpolate_census_batch(
+                [rows[idx] for idx in matched], [hits[idx] for idx in matched]
+            )
+            for idx, geom_dict in zip(matched, geoms):
+                results[idx] = (rows[idx]['id'], geom_dict)
+
+        return results
 
-            return row['id'], geom_dict
+    def first_hit(self, response_json):
+        if not 'hits' in response_json:
+            return None
+        elif response_json['hits'].get('hits', 0) == 0:
+            return None
+        elif len(response_json['hits']['hits']) == 0:
+            return None
+        return response_json['hits']['hits'][0]
 
     async def handle_census_range(self, range_from, range_to):
         from_int = 0
@@ -91,27 +305,60 @@ class ElasticGeocoder(AsyncGeocoder):
             'range_diff': range_diff
         }
 
+    async def census_side_range(self, props, side):
+        """
+        Range on one side of the street, using the integers computed when the
+        TIGER data was loaded and only parsing the raw range if they're missing
+        """
+        from_int = props.get('{}FROMINT'.format(side))
+        to_int = props.get('{}TOINT'.format(side))
+        if from_int is None or to_int is None:
+            return await self.handle_census_range(
+                props.get('{}FROMHN'.format(side)),
+                props.get('{}TOHN'.format(side))
+            )
+        return {
+            # Lean requests leave out EVEN, which the loader sets like this
+            'is_even': props.get(
+                '{}EVEN'.format(side), from_int % 2 == 0 and to_int % 2 == 0
+            ),
+            'from_int': from_int,
+            'to_int': to_int,
+            'range_diff': abs(to_int - from_int)
+        }
+
     async def interpolate_census(self, data, res_data):
-        tiger_feat = res_data['_source']
-        data_line = LineString(
-            [Point(*p) for p in tiger_feat['geometry']['coordinates']]
-        )
-        line_len = data_line.length
+        geoms = await self.interpolate_census_batch([data], [res_data])
+        return geoms[0]
 
-        if data['address_number']:
-            addr_int = int(re.sub('[^0-9]', '', str(data['address_number'])))
-        else:
-            addr_int = 0
+    async def interpolate_census_batch(self, rows, hits):
+        """
+        Interpolates the address number of each row along the TIGER ADDRFEAT
+        line of its hit, returning a list of lat/lon dictionaries
+        """
+        lines = []
+        fractions = []
+        for data, res_data in zip(rows, hits):
+            tiger_feat = res_data['_source']
+            lines.append(tiger_feat['geometry']['coordinates'])
+            fractions.append(await self.census_range_fraction(data, tiger_feat))
+
+        with self.metrics.timer('interpolation'):
+            inter_pts = interpolate_lines(
+                lines, fractions, geodesic=self.geodesic_interpolation
+            )
+        return [{'lat': float(pt[1]), 'lon': float(pt[0])} for pt in inter_pts]
+
+    async def census_range_fraction(self, data, tiger_feat):
+        """
+        Returns how far along the line an address falls, as a fraction of the
+        address range on the side of the street matching its parity
+        """
+        addr_int = parse_house_number(data['address_number'])
         addr_is_even = addr_int % 2 == 0
 
-        l_range = await self.handle_census_range(
-            tiger_feat['properties']['LFROMHN'],
-            tiger_feat['properties']['LTOHN']
-        )
-        r_range = await self.handle_census_range(
-            tiger_feat['properties']['RFROMHN'],
-            tiger_feat['properties']['RTOHN']
-        )
+        l_range = await self.census_side_range(tiger_feat['properties'], 'L')
+        r_range = await self.census_side_range(tiger_feat['properties'], 'R')
 
         if addr_is_even == l_range['is_even']:
             tiger_range = l_range
@@ -123,17 +370,11 @@ class ElasticGeocoder(AsyncGeocoder):
 
         # Check for divide by zero errors, otherwise create distance
         if tiger_range['range_diff'] == 0:
-            range_dist = 0
+            return 0
         elif tiger_range['from_int'] > tiger_range['to_int']:
-            range_dist = ((tiger_range['from_int'] - addr_int) /
-                           tiger_range['range_diff']) * line_len
+            return (tiger_range['from_int'] - addr_int) / tiger_range['range_diff']
         else:
-            range_dist = ((addr_int - tiger_range['from_int']) /
-                           tiger_range['range_diff']) * line_len
-
-        inter_pt = data_line.interpolate(range_dist)
-
-        return {'lat': inter_pt.y, 'lon': inter_pt.x}
+            return (addr_int - tiger_range['from_int']) / tiger_range['range_diff']
 
     async def create_point_query(self, data):
         point_query = {
@@ -163,103 +404,41 @@ class ElasticGeocoder(AsyncGeocoder):
 
         return point_query
 
-    async def create_census_query(self, data):
-        census_query = {
-            'query': {
-                'bool': {
-                    'must': [
-                        {
-                            'bool': {
-                                'should': [
-                                    {
-                                        'bool': {
-                                            'must': [
-                                                {
-                                                    'bool': {
-                                                        'should': [
-                                                            {'range': {
-                                                                'properties.LFROMHN': {'lte': data['address_number']}}},
-                                                            {'range': {
-                                                                'properties.RFROMHN': {'lte': data['address_number']}}}
-                                                        ]
-                                                    }
-                                                },
-                                                {
-                                                    'bool': {
-                                                        'should': [
-                                                            {'range': {
-                                                                'properties.LTOHN': {'gte': data['address_number']}}},
-                                                            {'range': {
-                                                                'properties.RTOHN': {'gte': data['address_number']}}}
-                                                        ]
-                                                    }
-                                                }
-                                            ]
-                                        }
-                                    },
-                                    {
-                                        'bool': {
-                                            'must': [
-                                                {
-                                                    'bool': {
-                                                        'should': [
-                                                            {'range': {
-                                                                'properties.LFROMHN': {'gte': data['address_number']}}},
-                                                            {'range': {
-                                                                'properties.RFROMHN': {'gte': data['address_number']}}}
-                                                        ]
-                                                    }
-                                                },
-                                                {
-                                                    'bool': {
-                                                        'should': [
-                                                            {'range': {
-                                                                'properties.LTOHN': {'lte': data['address_number']}}},
-                                                            {'range': {
-                                                                'properties.RTOHN': {'lte': data['address_number']}}}
-                                                        ]
-                                                    }
-                                                }
-                                            ]
-                                        }
-                                    }
-                                ]
-                            }
-                        }
-                    ],
-                    'should': [],
-                    'filter': {
-                        'bool': {
-                            'must': [
-                                {'term': {'properties.STATE': data['state_name'].lower()}},
-                                {
-                                    'bool': {
-                                        'should': [
-                                            {'term': {'properties.ZIPL': str(data['zip_code'])}},
-                                            {'term': {'properties.ZIPR': str(data['zip_code'])}}
-                                        ]
-                                    }
-                                }
-                            ]
-                        }
-                    }
-                }
-            }
-        }
+    def street_term(self, token):
+        """
+        Term query for a FULLNAME token, matching either spelling of a
+        directional since words like North can also be part of a name
+        """
+        if token in DIRECTIONAL_FORMS:
+            return {'terms': {'properties.FULLNAME': DIRECTIONAL_FORMS[token]}}
+        return {'term': {'properties.FULLNAME': token}}
+
+    def census_query_values(self, data):
+        """Arguments to census_query for a row"""
+        addr_int = parse_house_number(data['address_number'])
+        street_terms = []
+        should_terms = []
         if data.get('street_name_post_type'):
-            census_query['query']['bool']['should'].append(
+            should_terms.append(
                 {'term': {'properties.FULLNAME': data['street_name_post_type'].lower()}}
             )
 
         if data.get('street_name'):
             for s in data['street_name'].split(' '):
-                census_query['query']['bool']['must'].append(
-                    {'term': {"properties.FULLNAME": s.lower()}}
-                )
+                street_terms.append(self.street_term(s.lower()))
 
         if data['place_name']:
             for p in data['place_name'].split(' '):
-                census_query['query']['bool']['should'].append(
-                    {'term': {'properties.PLACE': p.lower()}}
-                )
-        return census_query
+                should_terms.append({'term': {'properties.PLACE': p.lower()}})
+
+        return {
+            'addr_int': addr_int,
+            'is_even': addr_int % 2 == 0,
+            'state': data['state_name'].lower(),
+            'zip_code': str(data['zip_code']),
+            'street_terms': street_terms,
+            'should_terms': should_terms
+        }
+
+    async def create_census_query(self, data):
+        return census_query(**self.census_query_values(data))
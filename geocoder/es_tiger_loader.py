@@ -1,32 +1,41 @@
-from zipfile import ZipFile
-import boto3
 import sys
 import json
 import csv
 import os
+import re
 import argparse
+import copy
 import string
-from io import BytesIO
-import shapefile
+import shutil
+import tempfile
 import pyproj
+import numpy as np
 from random import SystemRandom
-from itertools import chain
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from elasticsearch import Elasticsearch, helpers
-from rtree import index
-from shapely.geometry import Polygon
+from shapely.geometry import shape
+from place_index import PlaceIndex
+from tiger_source import make_tiger_source, read_shapefile
 
 
 CURRENT_DIR = os.path.dirname(__file__)
 
-wgs84 = pyproj.Proj('+init=EPSG:4326')
-nad83 = pyproj.Proj('+init=EPSG:4269')
+# PROJ picks the datum transformation by location, which is a no-op in most
+# of the US, so transforms are skipped where they'd move points less than
+# this many degrees (about a millimeter)
+DATUM_TOLERANCE = 1e-8
+
+nad83_to_wgs84 = pyproj.Transformer.from_crs('EPSG:4269', 'EPSG:4326', always_xy=True)
+
+
+def is_identity(transformer, bbox, tolerance=DATUM_TOLERANCE):
+    """Whether transformer moves the corners and center of bbox less than tolerance"""
+    lons = np.array([bbox[0], bbox[0], bbox[2], bbox[2], (bbox[0] + bbox[2]) / 2.0])
+    lats = np.array([bbox[1], bbox[3], bbox[1], bbox[3], (bbox[1] + bbox[3]) / 2.0])
+    new_lons, new_lats = transformer.transform(lons, lats)
+    return max(np.abs(new_lons - lons).max(), np.abs(new_lats - lats).max()) < tolerance
 
-s3 = boto3.resource(
-    's3',
-    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-    aws_session_token=os.getenv('AWS_SESSION_TOKEN')
-)
 
 parser = argparse.ArgumentParser(description='Elasticsearch census loader')
 
@@ -36,6 +45,21 @@ parser.add_argument('-b', '--s3_bucket', dest='s3_bucket', required=False,
                     default='nvf-tiger-2016')
 parser.add_argument('-e', '--es_host', dest='es_host', required=False,
                     help='Specify Elasticsearch host', default='elasticsearch')
+parser.add_argument('--cache_dir', dest='cache_dir', required=False,
+                    help='Directory for caching TIGER zips between loads, defaults to a temporary one')
+parser.add_argument('--source_dir', dest='source_dir', required=False,
+                    help='Load offline from a TIGER_DATA directory made by create_tiger_s3.sh')
+parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                    help='Number of processes decoding and transforming counties')
+parser.add_argument('--prefetch', dest='prefetch', type=int, default=2,
+                    help='Counties to download ahead of the busy workers')
+parser.add_argument('--index_mode', dest='index_mode', choices=['bulk', 'live'], default='bulk',
+                    help='bulk builds the index offline then swaps it into the census alias, '
+                    'live adds it to the alias before indexing')
+parser.add_argument('--chunk_bytes', dest='chunk_bytes', type=int, default=10 * 1024 * 1024,
+                    help='Max size of each bulk request in bytes')
+parser.add_argument('--replicas', dest='replicas', type=int, default=1,
+                    help='Replicas to restore once bulk indexing is done')
 
 
 with open(os.path.join(CURRENT_DIR, 'es', 'census_schema.json'), 'r') as f:
@@ -93,51 +117,117 @@ tiger_settings = {
 }
 
 
-def make_place_rtree(bucket_str, state_str):
-    fips_state = fips_state_map[state_str]
-    place_obj = s3.Object(bucket_str, 'PLACE/tl_2016_{}_place.zip'.format(fips_state))
-    place_bytes = BytesIO(place_obj.get()['Body'].read())
-    place_zip = ZipFile(place_bytes)
-    place_shp = shapefile.Reader(
-        shp=BytesIO(place_zip.read('tl_2016_{}_place.shp'.format(fips_state))),
-        dbf=BytesIO(place_zip.read('tl_2016_{}_place.dbf'.format(fips_state)))
-    )
-
-    place_idx = index.Index()
-    place_map = {}
-    name_idx = list(filter(lambda x: x[1][0] == 'NAME', enumerate(place_shp.fields)))[0][0]
-
-    for idx, shape in enumerate(place_shp.shapeRecords()):
-        place_map[idx] = {
-            'shape': shape,
-            'name': shape.record[name_idx],
-            'geom': Polygon(shape.shape.points)
-        }
-        sh = shape.shape.bbox
-        place_idx.insert(idx, (sh[1], sh[0], sh[3], sh[2]))
-    return place_map, place_idx
-
-
-def process_zip(obj):
-    tiger_key = obj.key[3:-4]
-    tiger_bytes = BytesIO(obj.get()['Body'].read())
-    zip_tiger = ZipFile(tiger_bytes)
-    return shapefile.Reader(
-        shp=BytesIO(zip_tiger.read('{}.shp'.format(tiger_key))),
-        dbf=BytesIO(zip_tiger.read('{}.dbf'.format(tiger_key)))
+# Applied while bulk indexing, since nothing queries the index until it's
+# swapped into the alias
+BULK_INDEX_SETTINGS = {
+    'refresh_interval': '-1',
+    'number_of_replicas': 0
+}
+# Indices created by earlier versions of the loader, named without the state
+LEGACY_INDEX_RE = re.compile(r'^tiger-[a-z0-9]{6}$')
+
+
+def create_bulk_index(es, index_name):
+    """Creates an index with refreshing and replication off for bulk loading"""
+    settings = copy.deepcopy(tiger_settings)
+    settings['settings']['index'].update(BULK_INDEX_SETTINGS)
+    es.indices.create(index=index_name, body=settings)
+
+
+def finish_bulk_index(es, index_name, replicas=1, request_timeout=3600):
+    """
+    Refreshes and force merges a bulk loaded index down to one segment,
+    then restores the default refresh interval and adds replicas
+    """
+    es.indices.refresh(index=index_name, request_timeout=request_timeout)
+    es.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=request_timeout)
+    es.indices.put_settings(
+        index=index_name,
+        body={'index': {'refresh_interval': None, 'number_of_replicas': replicas}}
     )
-
-
-def make_bbox_poly(bbox):
-    return Polygon([(bbox[0], bbox[1]), (bbox[0], bbox[3]),
-                    (bbox[2], bbox[3]), (bbox[2], bbox[1])])
-
-
-def process_records(reader, place_idx, state_str):
+    es.cluster.health(index=index_name, wait_for_status='yellow', request_timeout=request_timeout)
+
+
+def find_legacy_indices(es, state_str, alias='census'):
+    """
+    Returns the indices behind alias named tiger-xxxxxx by earlier versions
+    of the loader that only hold this state's features, which a new load of
+    the state replaces, and the ones that also hold other states
+    """
+    replaced, mixed = [], []
+    indices = es.indices.get_alias(name=alias, ignore=404)
+    for index in indices if 'error' not in indices else []:
+        if not LEGACY_INDEX_RE.match(index):
+            continue
+        in_state = es.count(
+            index=index, body={'query': {'match': {'properties.STATE': state_str}}}
+        )['count']
+        if not in_state:
+            continue
+        if in_state == es.count(index=index)['count']:
+            replaced.append(index)
+        else:
+            mixed.append(index)
+    return replaced, mixed
+
+
+def swap_aliases(es, aliases, index_name, old_pattern, legacy_indices=()):
+    """
+    Atomically points each alias at index_name in place of any indices
+    matching old_pattern or in legacy_indices, and then deletes those indices
+    """
+    old_indices = [
+        i for i in es.indices.get(index=old_pattern, ignore_unavailable=True) if i != index_name
+    ] + list(legacy_indices)
+    actions = []
+    for alias in aliases:
+        actions.extend({'remove': {'index': i, 'alias': alias}}
+                       for i in old_indices if es.indices.exists_alias(index=i, name=alias))
+        actions.append({'add': {'index': index_name, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    if old_indices:
+        es.indices.delete(index=','.join(old_indices))
+    return old_indices
+
+
+def make_place_index(source, state_str):
+    fips_state = fips_state_map[state_str]
+    place_shp = read_shapefile(source, 'PLACE/tl_2016_{}_place.zip'.format(fips_state))
+    return PlaceIndex.from_shapefile(place_shp)
+
+
+def make_range_fields(atr):
+    """
+    Parses the TIGER house number range on each side of the street into
+    integers, adding an integer_range for querying, the original from and to
+    numbers for interpolation, and whether the range is even. Sides without
+    a numeric range are left out so they can't match.
+    """
+    range_fields = {}
+    for side in ['L', 'R']:
+        range_from = atr.get('{}FROMHN'.format(side)) or ''
+        range_to = atr.get('{}TOHN'.format(side)) or ''
+        if not (range_from.isdigit() and range_to.isdigit()):
+            continue
+        from_int, to_int = int(range_from), int(range_to)
+        range_fields.update({
+            '{}FROMINT'.format(side): from_int,
+            '{}TOINT'.format(side): to_int,
+            '{}RANGE'.format(side): {'gte': min(from_int, to_int), 'lte': max(from_int, to_int)},
+            '{}EVEN'.format(side): from_int % 2 == 0 and to_int % 2 == 0
+        })
+    return range_fields
+
+
+def process_records(reader, place_index, state_str):
     field_names = [f[0] for f in reader.fields[1:]]
     feature_list = list()
+    shape_records = reader.shapeRecords()
+    place_names = place_index.assign(
+        [shape(sr.shape.__geo_interface__) for sr in shape_records]
+    )
 
-    for sr in reader.shapeRecords():
+    for sr, place_name in zip(shape_records, place_names):
         atr = dict(zip(field_names, sr.record))
         # Getting type error on bytes, converting
         for k in atr:
@@ -145,58 +235,176 @@ def process_records(reader, place_idx, state_str):
                 atr[k] = atr[k].decode('utf-8').strip()
 
         atr['STATE'] = state_str
-        sh = sr.shape.bbox
-        for fid in place_idx.intersection([sh[1], sh[0], sh[3], sh[2]]):
-            line_box = make_bbox_poly(sh)
-            if not line_box.is_valid:
-                continue
-            if line_box.intersects(place_map[fid]['geom']):
-                atr['PLACE'] = place_map[fid]['name']
-                break
+        atr.update(make_range_fields(atr))
+        if place_name:
+            atr['PLACE'] = place_name
 
         geom = sr.shape.__geo_interface__
-        geom['coordinates'] = [
-            pyproj.transform(nad83, wgs84, p[0], p[1]) for p in geom['coordinates']
-        ]
-
         feature_list.append(dict(type='Feature', geometry=geom, properties=atr))
 
+    reproject_features(feature_list, reader.bbox)
     return feature_list
 
 
-if __name__ == '__main__':
-    args = parser.parse_args()
+def reproject_features(feature_list, bbox, transformer=nad83_to_wgs84):
+    """
+    Reprojects the LineString coordinates of every feature within bbox in
+    place from NAD83 to WGS84, transforming all of them as one array
+    """
+    if not feature_list or is_identity(transformer, bbox):
+        return
+    coords = [f['geometry']['coordinates'] for f in feature_list]
+    points = np.array([p for line in coords for p in line], dtype=float)
+    lons, lats = transformer.transform(points[:, 0], points[:, 1])
+    points = list(zip(lons.tolist(), lats.tolist()))
 
-    rand_str = ''.join(SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(6))
-    index_name = 'tiger-{}'.format(rand_str)
+    start = 0
+    for feat, line in zip(feature_list, coords):
+        feat['geometry']['coordinates'] = points[start:start + len(line)]
+        start += len(line)
+
+
+# Place index for each county worker process, loaded with its first county
+worker_state = {}
+
+
+def load_county(source, key, content_id, state_str, place_index_file):
+    """Downloads, decodes and transforms a single county in a worker process"""
+    if 'place_index' not in worker_state:
+        worker_state['place_index'] = PlaceIndex.load(place_index_file)
+    return process_records(
+        read_shapefile(source, key, content_id), worker_state['place_index'], state_str
+    )
+
+
+def load_counties_parallel(source, keys, state_str, place_index, workers, prefetch=2):
+    """
+    Yields the features of each county as soon as a worker finishes it, with
+    at most workers + prefetch counties downloading or waiting to be indexed
+    at once. Memory only stays bounded if the consumer doesn't read ahead
+    without limit, as bulk_index makes sure of. Keys are (key, content id)
+    tuples from source.list. The place index is saved to a temporary file
+    that each worker loads once.
+    """
+    keys = iter(keys)
+    with tempfile.NamedTemporaryFile(suffix='.pickle') as place_index_f, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        place_index.save(place_index_f.name)
+        pending = set()
+        while True:
+            for key, content_id in islice(keys, workers + prefetch - len(pending)):
+                pending.add(executor.submit(
+                    load_county, source, key, content_id, state_str, place_index_f.name
+                ))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def bulk_index(es, actions, max_chunk_bytes, thread_count=8, batch_size=50000):
+    """
+    Sends actions with parallel_bulk, yielding its (ok, item) results.
+    parallel_bulk reads its input as fast as it can, ahead of the requests,
+    so it's given batch_size actions at a time to bound how many are held in
+    memory.
+    """
+    actions = iter(actions)
+    while True:
+        sent = 0
+        for ok, item in helpers.parallel_bulk(
+            es,
+            islice(actions, batch_size),
+            thread_count=thread_count,
+            # Large enough that requests are limited by bytes rather than count
+            chunk_size=100000,
+            max_chunk_bytes=max_chunk_bytes
+        ):
+            sent += 1
+            yield ok, item
+        if sent < batch_size:
+            return
 
-    es = Elasticsearch(host=args.es_host)
-    es.indices.create(index=index_name, body=tiger_settings)
-    es.indices.put_alias(index=index_name, name='census')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
 
     if args.geo_id.isdigit():
         prefix = args.geo_id
         state_str = fips_state_map[prefix[:2]]
         prefix_str = '{}/tl_2016_{}'.format(prefix[:2], prefix)
+        geo_name = '{}-{}'.format(state_str.lower(), prefix)
     else:
         state_str = args.geo_id.upper()
         prefix = fips_state_map[state_str]
         prefix_str = prefix + '/'
+        geo_name = state_str.lower()
 
-    bucket = s3.Bucket(args.s3_bucket)
-    place_map, place_idx = make_place_rtree(args.s3_bucket, state_str)
+    # Index names include the state (and county) so that reloading replaces
+    # only earlier loads of the same area
+    rand_str = ''.join(SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(6))
+    index_name = 'tiger-{}-{}'.format(geo_name, rand_str)
+    # Every index is in the census alias, and in a per-state alias like
+    # census-wa that ElasticGeocoder can route queries to
+    aliases = ['census', 'census-{}'.format(state_str.lower())]
 
-    # Generator expression for pulling ADDRFEAT data for a single state
-    zip_yield = (process_records(process_zip(r), place_idx, state_str)
-                 for r in bucket.objects.filter(Prefix=prefix_str))
+    es = Elasticsearch(host=args.es_host)
+    if args.index_mode == 'bulk':
+        create_bulk_index(es, index_name)
+    else:
+        es.indices.create(index=index_name, body=tiger_settings)
+        es.indices.update_aliases(body={
+            'actions': [{'add': {'index': index_name, 'alias': a}} for a in aliases]
+        })
+
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix='tiger_cache')
+    source = make_tiger_source(cache_dir, s3_bucket=args.s3_bucket, source_dir=args.source_dir)
+    county_keys = source.list(prefix_str)
+    place_index = make_place_index(source, state_str)
+
+    if args.workers > 1:
+        zip_yield = load_counties_parallel(
+            source,
+            county_keys,
+            state_str,
+            place_index,
+            args.workers,
+            prefetch=args.prefetch
+        )
+    else:
+        # Generator expression for pulling ADDRFEAT data for a single state
+        zip_yield = (process_records(read_shapefile(source, key, content_id), place_index, state_str)
+                     for key, content_id in county_keys)
 
     # Generator expression unpacking sublist and yielding ES object
     es_gen = ({'_index': index_name,
                '_type': 'addrfeat',
                '_source': f} for sub in zip_yield for f in sub)
 
-    for ok, item in helpers.parallel_bulk(es, es_gen, thread_count=8):
+    for ok, item in bulk_index(es, es_gen, args.chunk_bytes):
         if not ok:
             print('Error: {}'.format(item))
 
+    if args.index_mode == 'bulk':
+        finish_bulk_index(es, index_name, replicas=args.replicas)
+        legacy_indices, mixed_indices = find_legacy_indices(es, state_str)
+        if args.geo_id.isdigit():
+            # A county load doesn't replace a legacy index of its whole state
+            legacy_indices, mixed_indices = [], legacy_indices + mixed_indices
+        if mixed_indices:
+            print('Warning: {} still in the census alias with {} features'.format(
+                ', '.join(mixed_indices), state_str
+            ))
+        replaced = swap_aliases(
+            es, aliases, index_name, 'tiger-{}-*'.format(geo_name), legacy_indices
+        )
+        print('Swapped {} aliases to {}, replacing {}'.format(
+            ' and '.join(aliases), index_name, replaced or 'nothing'
+        ))
+    else:
+        es.indices.refresh(index=index_name)
+
     print(es.count(index=index_name))
+    if not args.cache_dir:
+        shutil.rmtree(cache_dir, ignore_errors=True)
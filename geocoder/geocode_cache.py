@@ -0,0 +1,142 @@
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+class GeocodeCache(object):
+    """
+    Two tier cache of geocoding results keyed by a normalized address string,
+    with an in-memory LRU in front of an optional SQLite file that persists
+    results between runs.
+
+    Failed matches are cached as well (with a geometry of None) but expire
+    after negative_ttl seconds, so addresses that didn't match can be retried
+    once the TIGER data or geocoder has been updated.
+
+    The file can be shared by several processes, like the shards of a
+    sharded run, and is used from the event loop, so no call may wait long
+    for another process. It's opened in WAL mode so reads never wait for
+    writers. New results are buffered in memory and written every
+    commit_every rows or commit_interval seconds with one executemany and
+    commit, so the write lock is only held for that statement. If another
+    process holds the lock for more than busy_timeout seconds, the rows stay
+    buffered (up to max_unwritten of them) for the next write.
+    """
+
+    def __init__(self, path=None, max_size=100000, negative_ttl=30 * 24 * 3600,
+                 commit_every=100, commit_interval=0.5, busy_timeout=0.05,
+                 max_unwritten=10000):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.busy_timeout = busy_timeout
+        self.max_unwritten = max_unwritten
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.unwritten = []
+        self.last_commit = time.monotonic()
+
+        self.db = None
+        if path:
+            # Setting up the file can wait for other processes doing the same
+            self.db = sqlite3.connect(path, timeout=30)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            # Durable enough for a cache, and commits don't wait for an fsync
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(
+                '''CREATE TABLE IF NOT EXISTS geocode_cache (
+                    address TEXT PRIMARY KEY,
+                    lat REAL,
+                    lon REAL,
+                    created REAL
+                )'''
+            )
+            self.db.commit()
+            self.set_busy_timeout(busy_timeout)
+
+    def set_busy_timeout(self, seconds):
+        self.db.execute('PRAGMA busy_timeout = {:d}'.format(int(seconds * 1000)))
+
+    def get(self, key):
+        """
+        Returns a tuple of whether the key was found and the cached geometry,
+        which is None for a cached failed match.
+        """
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+        elif self.db is not None:
+            db_row = self.db.execute(
+                'SELECT lat, lon, created FROM geocode_cache WHERE address = ?', (key,)
+            ).fetchone()
+            if db_row is not None:
+                lat, lon, created = db_row
+                geom = None if lat is None else {'lat': lat, 'lon': lon}
+                entry = (geom, created)
+                self.remember(key, entry)
+
+        if entry is None or self.is_expired(entry):
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, entry[0]
+
+    def set(self, key, geom):
+        entry = (geom, time.time())
+        self.remember(key, entry)
+        if self.db is not None:
+            self.unwritten.append(
+                (key, geom['lat'] if geom else None, geom['lon'] if geom else None, entry[1])
+            )
+            if (len(self.unwritten) >= self.commit_every or
+                    time.monotonic() - self.last_commit >= self.commit_interval):
+                self.write()
+
+    def write(self):
+        """
+        Writes buffered rows in one short transaction, keeping them for the
+        next write if the database is locked
+        """
+        self.last_commit = time.monotonic()
+        if not self.unwritten:
+            return
+        try:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?)', self.unwritten
+            )
+            self.db.commit()
+        except sqlite3.OperationalError as e:
+            self.db.rollback()
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            # Results are still in memory, so only the oldest rows are
+            # dropped from the file if the lock is held for a long time
+            del self.unwritten[:-self.max_unwritten]
+            return
+        self.unwritten = []
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def is_expired(self, entry):
+        geom, created = entry
+        return geom is None and time.time() - created > self.negative_ttl
+
+    def stats(self):
+        total = self.hits + self.misses
+        return 'Cache hits: {}, misses: {} ({:2.1f}% hit rate)'.format(
+            self.hits, self.misses, (100.0 * self.hits / total) if total else 0.0
+        )
+
+    def close(self):
+        if self.db is not None:
+            # Nothing is waiting on the loop any more, so wait for the lock
+            self.set_busy_timeout(30)
+            self.write()
+            self.db.close()
+            self.db = None
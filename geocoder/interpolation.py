@@ -0,0 +1,62 @@
+import numpy as np
+
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def segment_lengths(start_pts, end_pts, geodesic=False):
+    """
+    Lengths of segments between arrays of lon/lat points, either planar (in
+    degrees, matching shapely) or great circle distance in meters
+    """
+    if not geodesic:
+        return np.hypot(end_pts[:, 0] - start_pts[:, 0], end_pts[:, 1] - start_pts[:, 1])
+
+    lon1, lat1 = np.radians(start_pts[:, 0]), np.radians(start_pts[:, 1])
+    lon2, lat2 = np.radians(end_pts[:, 0]), np.radians(end_pts[:, 1])
+    hav = (np.sin((lat2 - lat1) / 2) ** 2 +
+           np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+
+
+def interpolate_lines(lines, fractions, geodesic=False):
+    """
+    Finds the point at a fraction of the length along each of a batch of
+    lines in one pass, returning an array of lon/lat rows.
+
+    All vertices are stacked into a single array with cumulative distances
+    along it (segments joining one line to the next are zero length), so the
+    segment holding each target distance can be found with searchsorted and
+    the point linearly interpolated along it.
+
+    Inputs:
+        - lines: List of coordinate sequences, as in GeoJSON LineStrings
+        - fractions: Fraction of each line's length to interpolate, clamped to 0-1
+        - geodesic: Measure length with great circle distance instead of degrees
+    """
+    if not len(lines):
+        return np.empty((0, 2))
+
+    counts = np.array([len(l) for l in lines])
+    coords = np.concatenate(
+        [np.asarray(l, dtype=float).reshape(-1, 2)[:, :2] for l in lines]
+    )
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    ends = starts + counts - 1
+
+    seg_lens = segment_lengths(coords[:-1], coords[1:], geodesic=geodesic)
+    seg_lens[starts[1:] - 1] = 0
+    cum_lens = np.concatenate(([0], np.cumsum(seg_lens)))
+
+    fractions = np.clip(np.asarray(fractions, dtype=float), 0, 1)
+    targets = cum_lens[starts] + fractions * (cum_lens[ends] - cum_lens[starts])
+
+    # Keeping each segment within its own line, including single point lines
+    seg_idx = np.searchsorted(cum_lens, targets, side='right') - 1
+    seg_idx = np.clip(seg_idx, starts, np.maximum(starts, ends - 1))
+    next_idx = np.minimum(seg_idx + 1, ends)
+
+    seg_dist = cum_lens[next_idx] - cum_lens[seg_idx]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        seg_frac = np.where(seg_dist > 0, (targets - cum_lens[seg_idx]) / seg_dist, 0)
+
+    return coords[seg_idx] + seg_frac[:, None] * (coords[next_idx] - coords[seg_idx])
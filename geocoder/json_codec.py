@@ -0,0 +1,130 @@
+import json
+from collections import namedtuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+JsonCodec = namedtuple('JsonCodec', ['name', 'dumps', 'loads'])
+
+
+def stdlib_loads(data):
+    # json.loads only accepts bytes from Python 3.6
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def make_json_codec(name=None):
+    """
+    Returns the JsonCodec for the orjson, ujson or json module by name, or
+    the fastest one installed if name is None. dumps returns compact str and
+    loads takes str or bytes, whatever the backend.
+    """
+    if name is None:
+        name = 'orjson' if orjson else 'ujson' if ujson else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError('orjson is not installed')
+        return JsonCodec('orjson', lambda obj: orjson.dumps(obj).decode('utf-8'), orjson.loads)
+    elif name == 'ujson':
+        if ujson is None:
+            raise ImportError('ujson is not installed')
+        return JsonCodec('ujson', ujson.dumps, ujson.loads)
+    elif name == 'json':
+        return JsonCodec(
+            'json', lambda obj: json.dumps(obj, separators=(',', ':')), stdlib_loads
+        )
+    raise ValueError('Unknown JSON backend {}'.format(name))
+
+
+class Placeholder(object):
+    """
+    Marks a value to fill in when rendering a QueryTemplate. A placeholder
+    that's the last element of a list is filled with a list of items
+    spliced into it, and anywhere else with a single value.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def marker(self):
+        return '\u0000{}\u0000'.format(self.name)
+
+
+def replace_placeholders(obj):
+    if isinstance(obj, Placeholder):
+        return obj.marker()
+    elif isinstance(obj, dict):
+        return {k: replace_placeholders(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [replace_placeholders(v) for v in obj]
+    return obj
+
+
+def find_placeholders(obj, found=None, in_list=False):
+    """Dict of placeholder names in obj to whether they're list elements"""
+    if found is None:
+        found = {}
+    if isinstance(obj, Placeholder):
+        found[obj.name] = in_list
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            find_placeholders(v, found)
+    elif isinstance(obj, list):
+        for v in obj:
+            find_placeholders(v, found, in_list=True)
+    return found
+
+
+class QueryTemplate(object):
+    """
+    Query body serialized once with Placeholders, so rendering it for a row
+    only encodes the values that change and joins them with the constant
+    JSON around them, rather than building and serializing the whole nested
+    dict every time.
+    """
+
+    def __init__(self, query, codec=None):
+        self.codec = codec or make_json_codec()
+        placeholders = find_placeholders(query)
+        text = self.codec.dumps(replace_placeholders(query))
+        # Split the JSON into constant segments and (name, splice, leading
+        # comma) slots for the placeholders between them
+        self.parts = [text]
+        for name, splice in placeholders.items():
+            quoted = self.codec.dumps(Placeholder(name).marker())
+            parts = []
+            for part in self.parts:
+                if not isinstance(part, str):
+                    parts.append(part)
+                    continue
+                segments = part.split(quoted)
+                for idx, segment in enumerate(segments):
+                    comma = False
+                    if idx < len(segments) - 1 and splice and segment.endswith(','):
+                        segment, comma = segment[:-1], True
+                    parts.append(segment)
+                    if idx < len(segments) - 1:
+                        parts.append((name, splice, comma))
+            self.parts = parts
+
+    def render(self, **values):
+        """JSON for the query with each placeholder's value encoded in its place"""
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            name, splice, comma = part
+            if not splice:
+                out.append(self.codec.dumps(values[name]))
+            elif values[name]:
+                items = ','.join(self.codec.dumps(v) for v in values[name])
+                out.append(',' + items if comma else items)
+        return ''.join(out)
@@ -0,0 +1,217 @@
+import asyncio
+import time
+
+
+class RateLimited(Exception):
+    """
+    Raised from request_geocoder when a service rejects a request for being
+    over its rate limit, so that the row is retried instead of dropped
+    """
+    pass
+
+
+class LimiterSlot(object):
+    """Async context manager holding a limiter slot for the length of a request"""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.start = None
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        self.start = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.limiter.release(time.monotonic() - self.start, error=exc_type is not None)
+        return False
+
+
+class Limiter(object):
+    """
+    Base class for limiting requests to a geocoding service. acquire is awaited
+    before each request, and release is called afterwards with the request
+    latency in seconds and whether it raised an error.
+    """
+
+    def request(self):
+        return LimiterSlot(self)
+
+    async def acquire(self):
+        pass
+
+    def release(self, latency, error=False):
+        pass
+
+    def cancel(self):
+        """Gives back an acquired slot without a request having been made"""
+        pass
+
+
+class TokenBucket(Limiter):
+    """
+    Allows rate requests per second on average, with bursts of up to capacity
+    requests. An error empties the bucket, pausing requests briefly.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        self.refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= 1
+
+    def release(self, latency, error=False):
+        if error:
+            self.tokens = min(self.tokens, 0)
+
+    def cancel(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class AIMDLimiter(Limiter):
+    """
+    Adaptive concurrency limit using additive increase, multiplicative
+    decrease. Each successful request raises the limit by about one per round
+    trip. The limit is cut by backoff when a request fails, or when the
+    smoothed latency has stayed above latency_tolerance times a baseline for
+    patience seconds, so that jitter in single requests isn't mistaken for
+    overload. The baseline follows the smoothed latency slowly, over about
+    baseline_window seconds when latency rises and a tenth of that when it
+    falls. Cuts happen at most once per smoothed latency so that one slow
+    burst isn't counted many times.
+    """
+
+    def __init__(self, initial=10, min_limit=1, max_limit=500,
+                 latency_tolerance=2.0, backoff=0.5, smoothing=0.1,
+                 baseline_window=30.0, patience=1.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.baseline_window = baseline_window
+        self.patience = patience
+        self.in_flight = 0
+        self.avg_latency = None
+        self.baseline = None
+        self.updated = None
+        self.degraded_since = None
+        self.last_backoff = 0
+        self.waiters = []
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+
+    def update_latency(self, latency, now):
+        if self.avg_latency is None:
+            self.avg_latency = self.baseline = latency
+        else:
+            self.avg_latency += self.smoothing * (latency - self.avg_latency)
+            window = self.baseline_window
+            if self.avg_latency < self.baseline:
+                window /= 10
+            self.baseline += min(1.0, (now - self.updated) / window) * (
+                self.avg_latency - self.baseline
+            )
+        self.updated = now
+
+    def release(self, latency, error=False):
+        self.in_flight -= 1
+        now = time.monotonic()
+        self.update_latency(latency, now)
+
+        if self.avg_latency > self.latency_tolerance * self.baseline:
+            if self.degraded_since is None:
+                self.degraded_since = now
+        else:
+            self.degraded_since = None
+        overloaded = self.degraded_since is not None and now - self.degraded_since >= self.patience
+
+        if error or overloaded:
+            if now - self.last_backoff > self.avg_latency:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_backoff = now
+                if overloaded:
+                    # Latency has to stay degraded for another patience
+                    # seconds before the next cut
+                    self.degraded_since = now
+        elif self.degraded_since is None:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self.wake_waiters()
+
+    def cancel(self):
+        self.in_flight -= 1
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        # Woken waiters check the limit again before taking a slot
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def stats(self):
+        return 'Concurrency limit: {:d}, in flight: {}'.format(int(self.limit), self.in_flight)
+
+
+class ChainedLimiter(Limiter):
+    """Acquires each limiter in order, such as a concurrency limit and then a rate limit"""
+
+    def __init__(self, limiters):
+        self.limiters = limiters
+
+    async def acquire(self):
+        acquired = []
+        try:
+            for limiter in self.limiters:
+                await limiter.acquire()
+                acquired.append(limiter)
+        except BaseException:
+            # Cancelled or failed waiting on a later limiter, so give back
+            # the slots already taken
+            for limiter in reversed(acquired):
+                limiter.cancel()
+            raise
+
+    def release(self, latency, error=False):
+        for limiter in self.limiters:
+            limiter.release(latency, error=error)
+
+    def cancel(self):
+        for limiter in self.limiters:
+            limiter.cancel()
+
+
+class SemaphoreLimiter(Limiter):
+    """Fixed concurrency limit, wrapping the geocoder's semaphore"""
+
+    def __init__(self, sem):
+        self.sem = sem
+
+    async def acquire(self):
+        await self.sem.acquire()
+
+    def release(self, latency, error=False):
+        self.sem.release()
+
+    def cancel(self):
+        self.sem.release()
@@ -0,0 +1,50 @@
+import os
+import heapq
+import pickle
+import shutil
+import tempfile
+from itertools import islice
+
+
+def write_run(path, items):
+    with open(path, 'wb') as f:
+        for item in items:
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def external_sort(items, key, buffer_size=100000, tmp_dir=None):
+    """
+    Yields items sorted by key while holding at most buffer_size of them in
+    memory. Larger inputs are sorted in runs of buffer_size, which are
+    pickled to temporary files in tmp_dir and merged. Items with equal keys
+    keep their input order.
+    """
+    items = iter(items)
+    run = sorted(islice(items, buffer_size), key=key)
+    if len(run) < buffer_size:
+        for item in run:
+            yield item
+        return
+
+    sort_dir = tempfile.mkdtemp(prefix='geocoder-sort-', dir=tmp_dir)
+    try:
+        run_paths = []
+        while run:
+            path = os.path.join(sort_dir, 'run{}.pickle'.format(len(run_paths)))
+            write_run(path, run)
+            run_paths.append(path)
+            run = sorted(islice(items, buffer_size), key=key)
+        # merge takes from earlier runs first on ties, so the sort stays stable
+        for item in heapq.merge(*[read_run(p) for p in run_paths], key=key):
+            yield item
+    finally:
+        shutil.rmtree(sort_dir, ignore_errors=True)
@@ -1,5 +1,5 @@
 from async_geocoder import AsyncGeocoder
-import asyncio
+from limiter import RateLimited
 
 
 class MapzenGeocoder(AsyncGeocoder):
@@ -10,6 +10,7 @@ class MapzenGeocoder(AsyncGeocoder):
     """
     sem_count = 5
     conn_limit = 1
+    rate_limit = 6
     api_key = None
     mapzen_url = 'https://search.mapzen.com/v1/search/structured?api_key='
     # Mapping of columns to desired ones here, substitute other columns names
@@ -49,14 +50,16 @@ class MapzenGeocoder(AsyncGeocoder):
                 query_url += '&{}={}'.format(k, v)
 
         async with client.get(query_url) as response:
+            # Check if rate limited, if so, raise so the row is retried once
+            # the limiter backs off
+            # TODO: Figure out how to handle passing full day quota
+            if response.status == 429:
+                raise RateLimited('Mapzen returned 429')
             response_json = await response.json()
 
-            # Check if rate limited, if so, pause and pass
-            # TODO: Figure out how to handle passing full day quota
             if 'meta' in response_json:
                 if response_json['meta']['status_code'] == 429:
-                    asyncio.sleep(0.5)
-                    return None, None
+                    raise RateLimited('Mapzen returned 429')
 
             if len(response_json['features']) == 0:
                 return row['id'], None
@@ -0,0 +1,160 @@
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from collections import OrderedDict
+from aiohttp import web
+
+log = logging.getLogger()
+
+# Upper bounds in seconds, growing by sqrt(2) from half a millisecond to about 45 seconds
+LATENCY_BUCKETS = [0.0005 * 2 ** (i / 2.0) for i in range(34)]
+# Counters of rows by outcome, which together add up to the rows processed.
+# Other counters are exported as their own geocoder_<name>_total.
+ROW_STATUSES = ['matched', 'unmatched', 'failed']
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets, for latency percentiles"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+
+class StageTimer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.monotonic() - self.start)
+        return False
+
+
+class Metrics(object):
+    """
+    Counters, gauges and per-stage latency histograms for a geocoding run.
+    Gauges are functions called when metrics are reported, so queues and
+    buffers can be registered without being polled otherwise.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = OrderedDict()
+        self.gauges = OrderedDict()
+        self.histograms = OrderedDict()
+        self.last_report = (self.started, 0)
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def histogram(self, stage):
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram()
+        return self.histograms[stage]
+
+    def timer(self, stage):
+        """Context manager recording the time spent in a block for a stage"""
+        return StageTimer(self.histogram(stage))
+
+    def rows(self):
+        return sum(self.counters.get(s, 0) for s in ROW_STATUSES)
+
+    def report(self, since_start=False):
+        """One line summary, with rows/s since the previous report or the start"""
+        now = time.monotonic()
+        rows = self.rows()
+        last_time, last_rows = (self.started, 0) if since_start else self.last_report
+        self.last_report = (now, rows)
+        rate = (rows - last_rows) / (now - last_time) if now > last_time else 0.0
+
+        matched = self.counters.get('matched', 0)
+        unmatched = self.counters.get('unmatched', 0)
+        match_rate = 100.0 * matched / (matched + unmatched) if matched + unmatched else 0.0
+
+        parts = [
+            'rows: {}'.format(rows),
+            'rows/s: {:.1f}'.format(rate),
+            'match rate: {:.1f}%'.format(match_rate)
+        ]
+        parts += ['{}: {}'.format(name, fn()) for name, fn in self.gauges.items()]
+        parts += [
+            '{} p50/p99: {:.1f}/{:.1f}ms'.format(
+                stage, hist.quantile(0.5) * 1000, hist.quantile(0.99) * 1000
+            )
+            for stage, hist in self.histograms.items() if hist.count
+        ]
+        return ', '.join(parts)
+
+    def prometheus_text(self):
+        lines = [
+            'geocoder_uptime_seconds {:.3f}'.format(time.monotonic() - self.started),
+            '# TYPE geocoder_rows_total counter'
+        ]
+        for name in ROW_STATUSES:
+            if name in self.counters:
+                lines.append('geocoder_rows_total{{status="{}"}} {}'.format(
+                    name, self.counters[name]
+                ))
+        for name, value in self.counters.items():
+            if name not in ROW_STATUSES:
+                lines.append('# TYPE geocoder_{}_total counter'.format(name))
+                lines.append('geocoder_{}_total {}'.format(name, value))
+        for name, fn in self.gauges.items():
+            lines.append('geocoder_{} {}'.format(name, fn()))
+        lines.append('# TYPE geocoder_stage_seconds histogram')
+        for stage, hist in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                lines.append('geocoder_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                    stage, bound, cumulative
+                ))
+            lines.append('geocoder_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(
+                stage, hist.count
+            ))
+            lines.append('geocoder_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(stage, hist.sum))
+            lines.append('geocoder_stage_seconds_count{{stage="{}"}} {}'.format(stage, hist.count))
+        return '\n'.join(lines) + '\n'
+
+    async def log_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            log.info(self.report())
+
+    async def serve(self, port, host='0.0.0.0'):
+        """Exposes metrics in the Prometheus text format at /metrics"""
+        async def handle_metrics(request):
+            return web.Response(text=self.prometheus_text())
+
+        loop = asyncio.get_event_loop()
+        app = web.Application(loop=loop)
+        app.router.add_get('/metrics', handle_metrics)
+        return await loop.create_server(app.make_handler(), host, port)
@@ -0,0 +1,131 @@
+import os
+import re
+import json
+
+CURRENT_DIR = os.path.dirname(__file__)
+
+# TIGER abbreviates directionals, so full words are mapped to abbreviations
+DIRECTIONALS = {
+    'north': 'n',
+    'south': 's',
+    'east': 'e',
+    'west': 'w',
+    'northeast': 'ne',
+    'northwest': 'nw',
+    'southeast': 'se',
+    'southwest': 'sw'
+}
+# Every spelling of each abbreviated directional, since a word like North
+# can also be part of a street's name
+DIRECTIONAL_FORMS = {abbr: sorted([abbr, word]) for word, abbr in DIRECTIONALS.items()}
+
+# Secondary unit designators, which along with anything after them are
+# stripped from street names when they follow the street and precede a unit
+UNIT_DESIGNATORS = {
+    'apt', 'apartment', 'unit', 'ste', 'suite', 'bldg', 'building', 'fl', 'floor',
+    'rm', 'room', 'lot', 'spc', 'space', 'trlr', 'trailer', 'dept'
+}
+
+PUNCTUATION_RE = re.compile(r'[.,;]')
+LEADING_NUMBER_RE = re.compile(r'\s*(\d+)')
+
+
+def load_synonyms(path=None):
+    with open(path or os.path.join(CURRENT_DIR, 'es', 'synonyms.json'), 'r') as f:
+        return json.load(f)
+
+
+def compile_synonyms(synonym_lines, pick_canonical=None):
+    """
+    Compiles Elasticsearch synonym lines like 'avenue,av,ave' into a dict of
+    every variant to a canonical form, by default the first one
+    """
+    table = {}
+    for line in synonym_lines:
+        variants = [v.strip().lower() for v in line.split(',') if v.strip()]
+        canonical = pick_canonical(variants) if pick_canonical else variants[0]
+        for variant in variants:
+            table.setdefault(variant, canonical)
+    return table
+
+
+def pick_state_code(variants):
+    return next((v for v in variants if len(v) == 2), variants[0])
+
+
+class AddressNormalizer(object):
+    """
+    Normalizes address columns before they're sent to the geocoder with the
+    same synonym tables Elasticsearch uses to analyze TIGER data, compiled
+    once into dicts. State names become two letter codes, street suffixes
+    their canonical spelling and directionals TIGER's abbreviations, while
+    secondary units and house number suffixes are stripped. The normalized
+    values also make a stable cache key.
+    """
+
+    def __init__(self, synonyms=None):
+        synonyms = synonyms or load_synonyms()
+        self.states = compile_synonyms(synonyms['state_synonyms'], pick_state_code)
+        self.street_words = compile_synonyms(synonyms['address_synonyms'])
+        self.street_words.update(DIRECTIONALS)
+        self.field_normalizers = {
+            'address_number': self.normalize_number,
+            'street_name': self.normalize_street,
+            'street_name_post_type': self.normalize_street,
+            'place_name': self.normalize_text,
+            'state_name': self.normalize_state,
+            'zip_code': self.normalize_zip
+        }
+
+    def normalize_row(self, row):
+        """Copy of a row with its address columns normalized, matching names in any case"""
+        normalized = {}
+        for k, v in dict(row).items():
+            normalizer = self.field_normalizers.get(k.lower())
+            normalized[k] = normalizer(v) if normalizer and v is not None else v
+        return normalized
+
+    def tokens(self, value):
+        return PUNCTUATION_RE.sub(' ', str(value).lower()).split()
+
+    def normalize_text(self, value):
+        return ' '.join(self.tokens(value))
+
+    def normalize_number(self, value):
+        """Leading integer of a house number, dropping suffixes like 12B or 10 1/2"""
+        match = LEADING_NUMBER_RE.match(str(value))
+        return match.group(1) if match else self.normalize_text(value)
+
+    def is_unit(self, words, idx, street):
+        """
+        Whether words[idx] starts a secondary unit, which needs a street
+        before it and a unit number after it (or in it, like #5), so streets
+        like Lot Rd or Suite Ave are left alone
+        """
+        if not street:
+            return False
+        word = words[idx]
+        if word.startswith('#') and len(word) > 1:
+            return True
+        return (word in UNIT_DESIGNATORS or word == '#') and idx + 1 < len(words)
+
+    def normalize_street(self, value):
+        words = self.tokens(value)
+        tokens = []
+        for idx, token in enumerate(words):
+            if self.is_unit(words, idx, tokens):
+                break
+            tokens.append(self.street_words.get(token, token))
+        # Never turn a value into an empty street
+        return ' '.join(tokens) or self.normalize_text(value)
+
+    def normalize_state(self, value):
+        state = self.normalize_text(value)
+        return self.states.get(state, state)
+
+    def normalize_zip(self, value):
+        digits = str(value).strip().split('-')[0]
+        if digits.isdigit() and len(digits) < 5:
+            # Leading zeros are lost when ZIP codes are stored as numbers
+            digits = digits.zfill(5)
+        return digits[:5]
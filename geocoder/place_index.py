@@ -0,0 +1,85 @@
+import pickle
+from shapely import wkb
+from shapely.geometry import shape
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+
+class PlaceIndex(object):
+    """
+    Assigns Census place names to TIGER ADDRFEAT edges, using an STRtree of
+    the place polygons to find candidates and prepared geometries to test
+    them against each line.
+
+    Built once per state from the PLACE shapefile. Pickling stores only the
+    names and WKB of the places, and the tree and prepared geometries are
+    rebuilt on loading, so the index can be shared with worker processes
+    through save and load.
+    """
+
+    def __init__(self, names, geoms):
+        self.names = list(names)
+        self.geoms = list(geoms)
+        self.build()
+
+    def build(self):
+        self.tree = STRtree(self.geoms) if self.geoms else None
+        self.prepared = [prep(g) for g in self.geoms]
+        self.geom_idx = {id(g): idx for idx, g in enumerate(self.geoms)}
+
+    @classmethod
+    def from_shapefile(cls, reader):
+        name_idx = [f[0] for f in reader.fields[1:]].index('NAME')
+        names = []
+        geoms = []
+        for sr in reader.shapeRecords():
+            geom = shape(sr.shape.__geo_interface__)
+            if not geom.is_valid:
+                geom = geom.buffer(0)
+            name = sr.record[name_idx]
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            names.append(name.strip())
+            geoms.append(geom)
+        return cls(names, geoms)
+
+    def __getstate__(self):
+        return {'names': self.names, 'wkb': [g.wkb for g in self.geoms]}
+
+    def __setstate__(self, state):
+        self.names = state['names']
+        self.geoms = [wkb.loads(g) for g in state['wkb']]
+        self.build()
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def candidates(self, geom):
+        """Indices of places whose bounding boxes intersect geom, in index order"""
+        hits = self.tree.query(geom)
+        # Shapely 2 returns indices, earlier versions the geometries themselves
+        return sorted(self.geom_idx[id(h)] if hasattr(h, 'geom_type') else int(h)
+                      for h in hits)
+
+    def assign(self, lines):
+        """
+        Returns the name of the first place each line intersects, or None for
+        lines outside of every place
+        """
+        if self.tree is None:
+            return [None] * len(lines)
+        names = []
+        for line in lines:
+            name = None
+            for idx in self.candidates(line):
+                if self.prepared[idx].intersects(line):
+                    name = self.names[idx]
+                    break
+            names.append(name)
+        return names
@@ -0,0 +1,100 @@
+import asyncio
+import random
+import logging
+import aiohttp
+from limiter import RateLimited
+
+log = logging.getLogger()
+
+
+class GeocoderError(Exception):
+    """Error response from a geocoding service that retrying won't fix"""
+    pass
+
+
+class ServiceUnavailable(GeocoderError):
+    """
+    Transient error from a geocoding service, like Elasticsearch rejecting
+    searches when its queue is full, that's worth retrying after a backoff
+    """
+    pass
+
+
+class RetryRule(object):
+    """
+    How to retry one class of error: up to max_attempts tries in total, waiting
+    a random time of up to base_delay * 2 ** retries (capped at max_delay)
+    between them. Retries covered by the budget are only made while the
+    policy's retry budget has room.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=0.1, max_delay=10.0, use_budget=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.use_budget = use_budget
+
+    def delay(self, retries):
+        # "Full jitter" so retries from many rows that failed together spread out
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retries))
+
+
+DEFAULT_RULES = [
+    (RateLimited, RetryRule(max_attempts=50, base_delay=0.5, max_delay=30.0, use_budget=False)),
+    (ServiceUnavailable, RetryRule(max_attempts=5, base_delay=0.2, max_delay=10.0)),
+    (asyncio.TimeoutError, RetryRule(max_attempts=3, base_delay=0.5, max_delay=10.0)),
+    (aiohttp.ClientError, RetryRule(max_attempts=5, base_delay=0.2, max_delay=10.0))
+]
+
+
+class RetryPolicy(object):
+    """
+    Retries coroutines on errors matching one of its rules. Budgeted retries
+    are limited to budget_ratio of all calls (plus a small min_budget) so that
+    an outage doesn't multiply the load on the service with retries. Other
+    errors, and errors that run out of attempts or budget, are re-raised.
+    """
+
+    def __init__(self, rules=None, budget_ratio=0.1, min_budget=100):
+        self.rules = rules if rules is not None else DEFAULT_RULES
+        self.budget_ratio = budget_ratio
+        self.budget = float(min_budget)
+        self.max_budget = float(min_budget)
+        self.retries = 0
+        self.exhausted = 0
+
+    def rule_for(self, exc):
+        for exc_cls, rule in self.rules:
+            if isinstance(exc, exc_cls):
+                return rule
+        return None
+
+    def spend_budget(self):
+        if self.budget < 1:
+            return False
+        self.budget -= 1
+        return True
+
+    async def call(self, coro_fn, *args, **kwargs):
+        self.budget = min(self.max_budget, self.budget + self.budget_ratio)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await coro_fn(*args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                rule = self.rule_for(e)
+                if rule is None:
+                    raise
+                if attempt >= rule.max_attempts or (rule.use_budget and not self.spend_budget()):
+                    self.exhausted += 1
+                    raise
+                self.retries += 1
+                delay = rule.delay(attempt - 1)
+                log.debug('Retrying after {!r} in {:.2f}s (attempt {})'.format(e, delay, attempt))
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        return 'Retries: {}, rows out of retries: {}'.format(self.retries, self.exhausted)
@@ -1,20 +1,117 @@
 import os
+import sys
 import json
 import argparse
 from es_geocoder import ElasticGeocoder
+from csv_shards import run_sharded
+from columnar import is_columnar
+from compression import compression, strip_compression
 
 
 parser = argparse.ArgumentParser(description='Geocode script entrypoint')
 
-parser.add_argument('input_file', help='Input file relative to run.py script')
+parser.add_argument('input_file',
+                    help='Input JSON config, or CSV, Parquet or Arrow file relative to run.py script')
 parser.add_argument('-o', '--output_file', dest='output_file', required=False,
-                    help='Output file for script, defaults to data/INPUT_output.csv')
+                    help='Output CSV, Parquet or Arrow file for script, defaults to '
+                         'data/INPUT_output with the input\'s extension')
 parser.add_argument('-s', '--state', dest='state', required=False,
                     help='Two-letter postal code abbreviation to run only one state')
 parser.add_argument('-b', '--s3_bucket', dest='s3_bucket', required=False,
                     help='Specify S3 bucket if uploading result to S3')
 parser.add_argument('-e', '--es_host', dest='es_host', required=False,
                     help='Specify Elasticsearch host', default='elasticsearch')
+parser.add_argument('--batch_size', dest='batch_size', type=int,
+                    help='Send up to this many addresses per _msearch request, 0 disables batching')
+parser.add_argument('--batch_wait', dest='batch_wait', type=float,
+                    help='Max seconds to wait for a batch to fill before sending it')
+parser.add_argument('--cache_file', dest='cache_file', required=False,
+                    help='SQLite file for caching geocoding results between runs')
+parser.add_argument('--worker_count', dest='worker_count', type=int,
+                    help='Number of coroutines geocoding CSV rows concurrently')
+parser.add_argument('--input_queue_size', dest='input_queue_size', type=int,
+                    help='Max CSV rows read ahead of the geocoding workers')
+parser.add_argument('--output_queue_size', dest='output_queue_size', type=int,
+                    help='Max geocoded rows waiting to be written')
+parser.add_argument('--rate_limit', dest='rate_limit', type=float,
+                    help='Max geocoder requests per second')
+parser.add_argument('--adaptive_concurrency', dest='adaptive_concurrency',
+                    action='store_true', default=None,
+                    help='Adjust concurrent requests to the highest the geocoder handles')
+parser.add_argument('--dead_letter_file', dest='dead_letter_file', required=False,
+                    help='CSV for rows that failed after retries, defaults to OUTPUT_failed.csv')
+parser.add_argument('--metrics_port', dest='metrics_port', type=int,
+                    help='Serve Prometheus metrics on this port at /metrics')
+parser.add_argument('--metrics_interval', dest='metrics_interval', type=float,
+                    help='Seconds between logging metrics summaries')
+parser.add_argument('--checkpoint', dest='checkpoint', action='store_true', default=None,
+                    help='Write CSV output in order and periodically save progress')
+parser.add_argument('--checkpoint_interval', dest='checkpoint_interval', type=float,
+                    help='Seconds between saving checkpoints')
+parser.add_argument('--checkpoint_file', dest='checkpoint_file', required=False,
+                    help='Checkpoint file, defaults to OUTPUT.checkpoint')
+parser.add_argument('--resume', dest='resume', action='store_true', default=None,
+                    help='Resume a checkpointed CSV run from its last checkpoint')
+parser.add_argument('--state_routing', dest='state_routing', action='store_true', default=None,
+                    help='Search only the per-state census alias for each row')
+parser.add_argument('--no_normalize', dest='normalize', action='store_false', default=None,
+                    help='Send addresses to Elasticsearch without normalizing them first')
+parser.add_argument('--no_coalesce', dest='coalesce', action='store_false', default=None,
+                    help='Send a request for every row even if its address is already in flight')
+parser.add_argument('--no_lean_requests', dest='lean_requests', action='store_false', default=None,
+                    help='Request full Elasticsearch responses with every TIGER property')
+parser.add_argument('--json_backend', dest='json_backend', choices=['orjson', 'ujson', 'json'],
+                    help='JSON library for Elasticsearch requests, defaults to the fastest installed')
+parser.add_argument('--locality_sort', dest='locality_sort', action='store_true', default=None,
+                    help='Geocode rows grouped by state and ZIP code instead of input order')
+parser.add_argument('--sort_buffer_rows', dest='sort_buffer_rows', type=int,
+                    help='Rows held in memory while sorting CSV input for --locality_sort')
+parser.add_argument('--sort_dir', dest='sort_dir', required=False,
+                    help='Directory for --locality_sort temporary files, defaults to the system\'s')
+parser.add_argument('--stream_upload', dest='stream_upload', action='store_true', default=None,
+                    help='Upload output to the S3 bucket in parts while geocoding instead of '
+                         'writing it locally first')
+parser.add_argument('--upload_part_size', dest='upload_part_size', type=int,
+                    help='Bytes per S3 multipart upload part, at least 5MB')
+parser.add_argument('--upload_threads', dest='upload_threads', type=int,
+                    help='Threads uploading S3 parts')
+parser.add_argument('--workers', dest='workers', type=int, default=1,
+                    help='Split CSV input across this many geocoding processes')
+
+# Optional arguments passed through to the geocoder when supplied, overriding
+# the class defaults (and for JSON input, only if not set in the config)
+GEOCODER_ARGS = [
+    'batch_size',
+    'batch_wait',
+    'cache_file',
+    'worker_count',
+    'input_queue_size',
+    'output_queue_size',
+    'rate_limit',
+    'adaptive_concurrency',
+    'dead_letter_file',
+    'metrics_port',
+    'metrics_interval',
+    'checkpoint',
+    'checkpoint_interval',
+    'checkpoint_file',
+    'resume',
+    'state_routing',
+    'normalize',
+    'coalesce',
+    'lean_requests',
+    'json_backend',
+    'locality_sort',
+    'sort_buffer_rows',
+    'sort_dir',
+    'stream_upload',
+    'upload_part_size',
+    'upload_threads'
+]
+
+
+def geocoder_kwargs(args):
+    return {a: getattr(args, a) for a in GEOCODER_ARGS if getattr(args, a) is not None}
 
 
 if __name__ == '__main__':
@@ -22,24 +119,30 @@ if __name__ == '__main__':
     if args.input_file.endswith('.json'):
         with open(args.input_file, 'r') as f:
             config = json.load(f)
+        for k, v in geocoder_kwargs(args).items():
+            config.setdefault(k, v)
         elastic_geo = ElasticGeocoder(**config)
-    elif args.input_file.endswith('.csv'):
+    elif strip_compression(args.input_file).endswith('.csv') or is_columnar(args.input_file):
         if not args.output_file:
-            args.output_file = '.'.join(args.input_file.split('.')[:-1]) + '_output.csv'
-        if not args.s3_bucket:
-            elastic_geo = ElasticGeocoder(
-                csv_file=args.input_file,
-                output_file=args.output_file,
-                es_host=args.es_host
-            )
-        else:
-            elastic_geo = ElasticGeocoder(
-                csv_file=args.input_file,
-                output_file=args.output_file,
-                s3_bucket=args.s3_bucket,
-                es_host=args.es_host
-            )
+            base, ext = os.path.splitext(strip_compression(args.input_file))
+            args.output_file = base + '_output' + ext + args.input_file[len(base + ext):]
+        geo_kwargs = dict(
+            csv_file=args.input_file,
+            output_file=args.output_file,
+            es_host=args.es_host,
+            **geocoder_kwargs(args)
+        )
+        if args.s3_bucket:
+            geo_kwargs['s3_bucket'] = args.s3_bucket
+        if args.workers > 1:
+            if is_columnar(args.input_file) or is_columnar(args.output_file):
+                raise Exception('--workers is only supported for CSV files')
+            if compression(args.input_file):
+                raise Exception('--workers is only supported for uncompressed CSV input')
+            run_sharded(ElasticGeocoder, geo_kwargs, args.workers)
+            sys.exit(0)
+        elastic_geo = ElasticGeocoder(**geo_kwargs)
     else:
-        raise Exception('Must supply either json or csv input_file')
+        raise Exception('Must supply either json, csv, parquet or arrow input_file')
 
     elastic_geo.run()
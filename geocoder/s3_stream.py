@@ -0,0 +1,165 @@
+import io
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+
+log = logging.getLogger(__name__)
+
+# S3 rejects parts smaller than 5MB, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Writable file that streams to an S3 object with a multipart upload,
+    sending each part_size bytes as a part from a pool of threads while more
+    are still being written. write never blocks, so once it has submitted a
+    part (needs_drain is set) the writing coroutine should await drain,
+    which waits until fewer than max_pending parts are uploading. That keeps at most about part_size
+    times max_pending bytes in memory without stalling the event loop.
+
+    The object is only published by awaiting complete, after the file (and
+    anything wrapping it) has been closed. abort discards the upload, and
+    an upload that's garbage collected without being completed is aborted,
+    so a failed run never leaves a truncated object behind.
+    """
+
+    def __init__(self, bucket, key, client=None, part_size=8 * 1024 * 1024,
+                 threads=4, max_pending=None):
+        super().__init__()
+        # Set before anything that can raise, so __del__ can always abort
+        self.completed = False
+        self.aborted = False
+        self.upload_id = None
+        self.buffer = bytearray()
+        # Futures of parts still uploading, and the ETags of finished ones
+        self.in_flight = []
+        self.uploaded_parts = []
+        self.part_count = 0
+        self.needs_drain = False
+        self.position = 0
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_pending = max_pending or threads * 2
+        self.client = client or boto3.client('s3')
+        self.upload_id = self.client.create_multipart_upload(
+            Bucket=bucket, Key=key
+        )['UploadId']
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('write to closed file')
+        self.buffer.extend(b)
+        self.position += len(b)
+        if len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        return len(b)
+
+    def upload_part(self, data):
+        self.part_count += 1
+        self.in_flight.append(self.executor.submit(self.send_part, self.part_count, data))
+        self.needs_drain = True
+
+    def send_part(self, part_number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    async def drain(self):
+        """
+        Waits until fewer than max_pending parts are uploading, raising the
+        exception of any part that failed
+        """
+        self.collect_parts()
+        while len(self.in_flight) >= self.max_pending:
+            await asyncio.wait([asyncio.wrap_future(self.in_flight[0])])
+            self.collect_parts()
+        self.needs_drain = False
+
+    def collect_parts(self):
+        """
+        Moves finished parts out of in_flight, raising the exception of the
+        first one that failed
+        """
+        in_flight = []
+        for future in self.in_flight:
+            if future.done():
+                self.uploaded_parts.append(future.result())
+            else:
+                in_flight.append(future)
+        self.in_flight = in_flight
+
+    def close(self):
+        """Sends the last part, but doesn't complete the upload"""
+        if self.closed:
+            return
+        # An empty object still needs one (empty) part
+        if self.buffer or not self.part_count:
+            self.upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        super().close()
+
+    async def complete(self):
+        """Closes the file, waits for every part and completes the upload"""
+        try:
+            self.close()
+            parts = list(self.uploaded_parts)
+            for future in self.in_flight:
+                parts.append(await asyncio.wrap_future(future))
+            parts.sort(key=lambda part: part['PartNumber'])
+            await asyncio.get_event_loop().run_in_executor(
+                self.executor,
+                lambda: self.client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={'Parts': parts}
+                )
+            )
+        except Exception:
+            self.abort()
+            raise
+        self.completed = True
+        self.executor.shutdown(wait=False)
+        log.info('Uploaded {} bytes in {} parts to s3://{}/{}'.format(
+            self.position, self.part_count, self.bucket, self.key
+        ))
+
+    def abort(self):
+        """Stops the upload and discards its parts, without completing it"""
+        if self.completed or self.aborted:
+            return
+        self.aborted = True
+        for future in self.in_flight:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        super().close()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+
+    def __del__(self):
+        # IOBase closes files when they're collected, which must never
+        # publish a partial object
+        if not self.completed:
+            try:
+                self.abort()
+            except Exception:
+                pass
+        super().__del__()
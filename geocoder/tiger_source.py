@@ -0,0 +1,174 @@
+import os
+import uuid
+import boto3
+import shutil
+import hashlib
+from zipfile import ZipFile
+import shapefile
+
+SHAPEFILE_EXTS = ['shp', 'dbf']
+
+
+def make_s3_resource():
+    return boto3.resource(
+        's3',
+        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+        aws_session_token=os.getenv('AWS_SESSION_TOKEN')
+    )
+
+
+def file_md5(path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def temp_name(path):
+    """Unique name next to path, so that files can be moved into place atomically"""
+    return '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+
+
+class TigerCache(object):
+    """
+    Content-addressed directory of TIGER zips and their extracted shapefile
+    members. Zips are stored by content id (the S3 ETag) and extracted once,
+    so shapefiles are read straight from disk. Entries are written to
+    temporary names and renamed into place, so several processes can share
+    a cache.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(os.path.join(cache_dir, 'zips'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'shapefiles'), exist_ok=True)
+
+    def zip_path(self, content_id):
+        return os.path.join(self.cache_dir, 'zips', '{}.zip'.format(content_id))
+
+    def extract_dir(self, content_id):
+        return os.path.join(self.cache_dir, 'shapefiles', content_id)
+
+    def is_extracted(self, content_id):
+        return os.path.isdir(self.extract_dir(content_id))
+
+    def extract(self, zip_path, content_id, name):
+        """Extracts the .shp and .dbf members of a zip into its extract_dir"""
+        extract_dir = self.extract_dir(content_id)
+        tmp_dir = temp_name(extract_dir)
+        with ZipFile(zip_path) as zip_f:
+            for ext in SHAPEFILE_EXTS:
+                zip_f.extract('{}.{}'.format(name, ext), tmp_dir)
+        try:
+            os.rename(tmp_dir, extract_dir)
+        except OSError:
+            # Another process extracted it first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def shapefile_paths(self, content_id, name):
+        return [
+            os.path.join(self.extract_dir(content_id), '{}.{}'.format(name, ext))
+            for ext in SHAPEFILE_EXTS
+        ]
+
+
+class S3TigerSource(object):
+    """
+    Reads TIGER zips from an S3 bucket laid out by create_tiger_s3.sh,
+    downloading each zip to the cache unless a copy with the same ETag is
+    already there, and checking downloads against their MD5 ETag
+    """
+
+    def __init__(self, bucket_str, cache):
+        self.bucket_str = bucket_str
+        self.cache = cache
+        self.s3 = None
+
+    def __getstate__(self):
+        # Connections can't be shared with other processes
+        return {'bucket_str': self.bucket_str, 'cache': self.cache, 's3': None}
+
+    def resource(self):
+        if self.s3 is None:
+            self.s3 = make_s3_resource()
+        return self.s3
+
+    def list(self, prefix):
+        """Returns (key, content id) tuples for the zips starting with prefix"""
+        objs = self.resource().Bucket(self.bucket_str).objects.filter(Prefix=prefix)
+        return [(obj.key, obj.e_tag.strip('"')) for obj in objs if obj.key.endswith('.zip')]
+
+    def content_id(self, key):
+        return self.resource().Object(self.bucket_str, key).e_tag.strip('"')
+
+    def fetch(self, key, content_id):
+        """Returns the local path of a zip, downloading it if it isn't cached"""
+        zip_path = self.cache.zip_path(content_id)
+        if os.path.exists(zip_path):
+            return zip_path
+
+        tmp_path = temp_name(zip_path)
+        self.resource().Object(self.bucket_str, key).download_file(tmp_path)
+        # Multipart uploads have ETags that aren't the MD5 of the file
+        if '-' not in content_id and file_md5(tmp_path) != content_id:
+            os.remove(tmp_path)
+            raise IOError('Downloaded {} does not match its ETag {}'.format(key, content_id))
+        os.replace(tmp_path, zip_path)
+        return zip_path
+
+
+class LocalTigerSource(object):
+    """
+    Reads TIGER zips offline from a local directory laid out like the
+    TIGER_DATA directory created by create_tiger_s3.sh
+    """
+
+    def __init__(self, source_dir, cache):
+        self.source_dir = source_dir
+        self.cache = cache
+
+    def list(self, prefix):
+        keys = []
+        for root, _, files in os.walk(self.source_dir):
+            for f in files:
+                key = os.path.relpath(os.path.join(root, f), self.source_dir).replace(os.sep, '/')
+                if key.startswith(prefix) and key.endswith('.zip'):
+                    keys.append((key, self.content_id(key)))
+        return sorted(keys)
+
+    def content_id(self, key):
+        # Hashing the file's name, size and modification time avoids reading it
+        stat = os.stat(os.path.join(self.source_dir, key))
+        return hashlib.md5(
+            '{}:{}:{}'.format(key, stat.st_size, stat.st_mtime).encode('utf-8')
+        ).hexdigest()
+
+    def fetch(self, key, content_id):
+        return os.path.join(self.source_dir, key)
+
+
+def make_tiger_source(cache_dir, s3_bucket=None, source_dir=None):
+    """
+    Source for TIGER zips from a local directory if source_dir is set, or
+    otherwise S3, with zips and extracted shapefiles cached in cache_dir
+    """
+    cache = TigerCache(cache_dir)
+    if source_dir:
+        return LocalTigerSource(source_dir, cache)
+    return S3TigerSource(s3_bucket, cache)
+
+
+def read_shapefile(source, key, content_id=None):
+    """
+    Opens the shapefile in the zip at key, reading its members from disk and
+    only fetching the zip if they aren't already extracted in the cache
+    """
+    if content_id is None:
+        content_id = source.content_id(key)
+    name = os.path.basename(key)[:-len('.zip')]
+    if not source.cache.is_extracted(content_id):
+        source.cache.extract(source.fetch(key, content_id), content_id, name)
+    shp_path, dbf_path = source.cache.shapefile_paths(content_id, name)
+    return shapefile.Reader(shp=open(shp_path, 'rb'), dbf=open(dbf_path, 'rb'))